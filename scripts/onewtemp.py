@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 # Example script for using the direct Raspberry PI 1-wire interface (without owfs)
-# We don't use this at the moment.
+# The actual implementation used by the thermostat is in src/thermlib/w1if.py
 
 import logging
 
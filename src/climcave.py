@@ -13,6 +13,10 @@ import subprocess
 from thermlib import conftree
 from thermlib import utils
 from thermlib import owif
+from thermlib import sensorcache
+from thermlib import sampling
+from thermlib import metrics
+from thermlib import sigprof
 
 # Log the current temperatures and fan state.
 def logstate(exC, inC, fanB):
@@ -45,10 +49,17 @@ def fanstate():
     else:
         return pioif.state()
 
+# Read a temperature, going through the shared cache if one is configured
+def readtemp(id):
+    if g_tempcache:
+        return g_tempcache.get(sensorcache.make_key({"type": "onewire", "ids": [id]}),
+                               lambda: owif.readtemp(id), g_tempcachettl)
+    return owif.readtemp(id)
+
 def turnoffandsleep(s):
     global g_loopsleepsecs
     fanoff()
-    logerr.debug("Sleeping: %s", s)
+    logger.debug("Sleeping: %s", s)
     time.sleep(g_loopsleepsecs)
     return 0
 
@@ -72,6 +83,8 @@ def init():
     conf = utils.initcommon('CLIMCAVE_CONFIG')
     global logger
     logger = logging.getLogger(__name__)
+    metrics.setup(conf)
+    sigprof.setup(conf, "climcave")
 
     global g_templog
     g_templog = conf.get('templog')
@@ -85,6 +98,18 @@ def init():
             "No idtempext or idtempint defined in configuration")
         sys.exit(1)
 
+    global g_tempcache, g_tempcachettl
+    g_tempcache = None
+    g_tempcachettl = float(conf.get('tempcachettl') or 60)
+    tempcachedir = conf.get('tempcachedir')
+    if tempcachedir:
+        g_tempcache = sensorcache.get_cache(tempcachedir)
+
+    # Sampling interval: fast when close to switching, up to 20 mn when stable (we used to read
+    # every g_loopsleepsecs)
+    global g_sampler
+    g_sampler = sampling.make_sampler(conf, 60, 1200, 0.5)
+
     global g_using_t2ss
     g_using_t2ss = conf.get('using_t2ss')
     if g_using_t2ss:
@@ -108,8 +133,6 @@ def init():
 ####################
 ##### MAIN program
 
-init()
-
 # Wake up every 5 mn
 g_loopsleepsecs = 300
 
@@ -118,72 +141,81 @@ hyster = 0.05
 # Minimum time we stay on or off (loopsleepms will be used if it's bigger)
 minsecs = 120
 
-## Current state:
-# Last time we changed : the epoch
-lastchange = 0
-# Current fan state: off
-currentstate = 0
+def climmain():
+    init()
 
-while True:
-    # Get external and internal temperatures
-    try:
-        tempext = owif.readtemp(g_idtempext)
-        tempint = owif.readtemp(g_idtempint)
-        logger.debug("tempext: %s, tempint: %s", tempext, tempint)
-    except:
-        logger.exception("climcave: could not read temperatures")
-        # In any case, try to turn the fan off
-        currentstate = turnoffandsleep("Couldn't read temp")
-        continue
+    ## Current state:
+    # Last time we changed : the epoch
+    lastchange = 0
+    # Current fan state: off
+    currentstate = 0
 
-    ##### Read actual device state in case it's not what we think
-    try:
-        state = fanstate()
-    except:
-        currentstate = turnoffandsleep("Couldn't read device state")
-        continue
-    if state != currentstate:
-        logger.info("State read from device differs from expected")
-        currentstate = state
-
-    target= targetC()
-
-    # Compute desired state: turn off if inside too cool, on if too warm, 
-    desiredstate = currentstate
-    if currentstate == 1 and tempint < target - hyster:
-        desiredstate = 0
-    if currentstate == 0 and tempint > target + hyster:
-        desiredstate = 1
-    # stay off anyway if it's too warm outside
-    if tempext > tempint - 1:
-        desiredstate = 0
-
-    now = time.time()
-    if currentstate != desiredstate and now - lastchange > minsecs:
+    while True:
+        # Get external and internal temperatures
         try:
-            if desiredstate:
-                fanon()
-            else:
-                fanoff()
+            tempext = readtemp(g_idtempext)
+            tempint = readtemp(g_idtempint)
+            logger.debug("tempext: %s, tempint: %s", tempext, tempint)
         except:
-            currentstate = turnoffandsleep("Couldn't set outputs")
+            logger.exception("climcave: could not read temperatures")
+            # In any case, try to turn the fan off
+            currentstate = turnoffandsleep("Couldn't read temp")
             continue
-        currentstate = desiredstate
-        lastchange = now
-        #### Check device state after setting it
+
+        ##### Read actual device state in case it's not what we think
         try:
-            actualstate = fanstate()
+            state = fanstate()
         except:
-            currentstate = turnoffandsleep(
-                "Couldn't read device state after setting")
-            continue
-        if actualstate != currentstate:
-            currentstate = turnoffandsleep(
-                "Measured device state %s differs from expected (%s)" %
-                (actualstate, currentstate))
+            currentstate = turnoffandsleep("Couldn't read device state")
             continue
-
-    logstate(tempext, tempint, currentstate)
-
-    # Sleep
-    time.sleep(g_loopsleepsecs)
+        if state != currentstate:
+            logger.info("State read from device differs from expected")
+            currentstate = state
+
+        target= targetC()
+
+        # Compute desired state: turn off if inside too cool, on if too warm, 
+        desiredstate = currentstate
+        if currentstate == 1 and tempint < target - hyster:
+            desiredstate = 0
+        if currentstate == 0 and tempint > target + hyster:
+            desiredstate = 1
+        # stay off anyway if it's too warm outside
+        if tempext > tempint - 1:
+            desiredstate = 0
+
+        now = time.time()
+        if currentstate != desiredstate and now - lastchange > minsecs:
+            try:
+                if desiredstate:
+                    fanon()
+                else:
+                    fanoff()
+            except:
+                currentstate = turnoffandsleep("Couldn't set outputs")
+                continue
+            currentstate = desiredstate
+            lastchange = now
+            #### Check device state after setting it
+            try:
+                actualstate = fanstate()
+            except:
+                currentstate = turnoffandsleep(
+                    "Couldn't read device state after setting")
+                continue
+            if actualstate != currentstate:
+                currentstate = turnoffandsleep(
+                    "Measured device state %s differs from expected (%s)" %
+                    (actualstate, currentstate))
+                continue
+
+        logstate(tempext, tempint, currentstate)
+
+        # Sleep. The thresholds are the ones for the inside temp (the external temp condition is
+        # seen from the inside temp too).
+        time.sleep(g_sampler.next_interval(tempint,
+                                           [target - hyster, target + hyster, tempext + 1]))
+
+
+if __name__ == '__main__':
+    climmain()
@@ -0,0 +1,48 @@
+# Tests for thermlib.pwm.StaggeredPWM on a virtual clock
+
+from thermlib import pwm, scheduler
+
+import thermbench
+
+
+class _Relay(object):
+    def __init__(self, loop, name, events):
+        self.loop = loop
+        self.name = name
+        self.events = events
+    def turnon(self):
+        self.events.append((self.loop.now, self.name, "on"))
+    def turnoff(self):
+        self.events.append((self.loop.now, self.name, "off"))
+
+
+def _pwm(period=1000.0):
+    loop = thermbench.VirtualLoop()
+    events = []
+    pwmctl = pwm.StaggeredPWM(scheduler.ActuationScheduler(loop), period, 60)
+    return loop, events, pwmctl
+
+
+def test_staggered_windows():
+    loop, events, pwmctl = _pwm()
+    pwmctl.addzone("a", _Relay(loop, "a", events), 30)
+    pwmctl.addzone("b", _Relay(loop, "b", events), 30)
+    pwmctl.run(0.0)
+    loop.run_until(999.0)
+    assert events == [(0.0, "a", "on"), (300.0, "a", "off"), (300.0, "b", "on"),
+                      (600.0, "b", "off")]
+
+
+# Dropping from always on to a partial command must turn the relay off at the next period start,
+# and not turn it on again before the minimum off time.
+def test_always_on_to_partial():
+    loop, events, pwmctl = _pwm()
+    pwmctl.addzone("a", _Relay(loop, "a", events), 0)
+    pwmctl.addzone("b", _Relay(loop, "b", events), 100)
+    pwmctl.run(1000.0)
+    loop.run_until(1500.0)
+    assert events == [(1000.0, "b", "on")]
+    pwmctl.setcommand("b", 30)
+    loop.run_until(2999.0)
+    assert events == [(1000.0, "b", "on"), (2000.0, "b", "off"), (2060.0, "b", "on"),
+                      (2360.0, "b", "off")]
@@ -0,0 +1,102 @@
+# Tests for thermlib.w1if against a fake sysfs tree:
+#   devices/w1_bus_master1/therm_bulk_read
+#   devices/w1_bus_master1/28-xxxxxxxxxxxx/{w1_slave,temperature}
+#   devices/28-xxxxxxxxxxxx -> w1_bus_master1/28-xxxxxxxxxxxx
+
+import os
+
+import pytest
+
+from thermlib import w1if
+
+GOOD = "72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n"
+BADCRC = "72 01 4b 46 7f ff 0e 10 57 : crc=00 NO\n72 01 4b 46 7f ff 0e 10 57 t=23125\n"
+
+
+def _sensor(w1dir, sensorid, w1slave, temperature=None):
+    master = os.path.join(w1dir, "w1_bus_master1")
+    devdir = os.path.join(master, sensorid)
+    os.makedirs(devdir)
+    with open(os.path.join(devdir, "w1_slave"), "w") as f:
+        f.write(w1slave)
+    if temperature is not None:
+        with open(os.path.join(devdir, "temperature"), "w") as f:
+            f.write(temperature)
+    link = os.path.join(w1dir, sensorid)
+    os.symlink(os.path.join("w1_bus_master1", sensorid), link)
+    return link
+
+def _bulkfile(w1dir, contents=""):
+    fn = os.path.join(w1dir, "w1_bus_master1", "therm_bulk_read")
+    with open(fn, "w") as f:
+        f.write(contents)
+    return fn
+
+
+def test_good_crc(tmp_path):
+    w1dir = str(tmp_path)
+    devdir = _sensor(w1dir, "28-0300a2792076", GOOD)
+    assert w1if.readtemp(devdir) == 23.125
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076"], "w1dir": w1dir})
+    assert temp.bulkfiles == set()
+    assert temp.current() == 23.125
+    assert temp.quality[devdir]["ok"]
+
+def test_bad_crc(tmp_path):
+    w1dir = str(tmp_path)
+    devdir = _sensor(w1dir, "28-0300a2792076", BADCRC)
+    with pytest.raises(Exception):
+        w1if.readtemp(devdir)
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076"], "w1dir": w1dir})
+    with pytest.raises(Exception):
+        temp.current()
+    assert not temp.quality[devdir]["ok"]
+
+def test_bad_crc_left_out_of_average(tmp_path):
+    w1dir = str(tmp_path)
+    good = _sensor(w1dir, "28-0300a2792076", GOOD)
+    bad = _sensor(w1dir, "28-0300a2792077", BADCRC)
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076", "28-0300a2792077"], "w1dir": w1dir})
+    try:
+        assert temp.current() == 23.125
+        assert temp.quality[good]["ok"]
+        assert not temp.quality[bad]["ok"]
+    finally:
+        temp.close()
+
+def test_bulk_read_latched(tmp_path):
+    w1dir = str(tmp_path)
+    _sensor(w1dir, "28-0300a2792076", GOOD, "19500\n")
+    bulkfile = _bulkfile(w1dir)
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076"], "w1dir": w1dir})
+    assert temp.bulkfiles == set([bulkfile])
+    # The latched value, not the one from w1_slave
+    assert temp.current() == 19.5
+    with open(bulkfile) as f:
+        assert f.read() == "trigger\n"
+
+def test_bulk_read_no_latched_value(tmp_path):
+    w1dir = str(tmp_path)
+    _sensor(w1dir, "28-0300a2792076", GOOD, "")
+    _bulkfile(w1dir)
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076"], "w1dir": w1dir})
+    assert temp.current() == 23.125
+
+def test_bulk_read_disabled(tmp_path):
+    w1dir = str(tmp_path)
+    _sensor(w1dir, "28-0300a2792076", GOOD, "19500\n")
+    _bulkfile(w1dir)
+    temp = w1if.Temp({}, {"ids": ["28-0300a2792076"], "w1dir": w1dir, "bulk": False})
+    assert temp.bulkfiles == set()
+    assert temp.current() == 23.125
+
+def test_id_sysfs():
+    assert w1if.id_sysfs("28.762079A20003") == "28-0300a2792076"
+    assert w1if.id_sysfs("28-0300a2792076") == "28-0300a2792076"
+
+def test_id_sysfs_owfs_roundtrip():
+    pytest.importorskip("pyownet")
+    from thermlib import owif
+    assert owif.id_ow("28-0300a2792076") == "28.762079A20003"
+    assert owif.id_ow(w1if.id_sysfs("28.762079A20003")) == "28.762079A20003"
+    assert w1if.id_sysfs(owif.id_ow("28-0300a2792076")) == "28-0300a2792076"
@@ -0,0 +1,778 @@
+#!/usr/bin/python3
+
+# Micro-benchmarks for the thermlib hot paths. These run without any hardware or network: the
+# device interfaces are replaced by fakes.
+#
+# Usage: thermbench.py [-l] [-i] [-p] [-e] [-o results.json] [-c baseline.json] [-t threshold]
+#                      [name ...]
+#  -l: list the benchmark names
+#  -i: measure the import time and memory of each sensorfact backend module
+#  -p: simulate staggered PWM over many relays and report the peak concurrent load
+#  -e: check that PIDBank and PID.PID give bit-identical results (exit status 1 if not)
+#  -o: save the results (seconds per op) as JSON, for comparison across commits
+#  -c: compare the results with a file saved by -o, and exit with status 1 if a benchmark is
+#      slower than in the baseline by more than threshold (a fraction, default 0.25)
+#  name: only run the benchmarks with names starting with one of the arguments
+#
+# E.g. run "thermbench.py -o base.json" before a change, and "thermbench.py -c base.json" after.
+# thermbench-results.json holds reference results (see the commit, python and machine in it),
+# regenerate it with "thermbench.py -o thermbench-results.json" when the benchmarks change.
+# Benchmarks using a backend library which is not installed (paho, pyownet) are skipped.
+
+import os
+import sys
+import json
+import time
+import logging
+
+_benchmarks = {}
+
+# Decorator registering a benchmark. The function does any setup and returns a callable which
+# is the operation to measure.
+def bench(name):
+    def deco(func):
+        _benchmarks[name] = func
+        return func
+    return deco
+
+# Return the best time per call in seconds, over several repeats of enough calls to last at least
+# mintime seconds.
+def measure(op, mintime=0.2, repeat=3):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(1.2 * mintime / elapsed))
+    best = elapsed
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            op()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+########## zwavejs2mqtt
+
+class FakeMqttClient(object):
+    def subscribe(self, topic):
+        pass
+    def publish(self, topic, message):
+        pass
+
+class FakeMqttMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+_zwtopic = "zwave/nodeID_8/49/0/Air_temperature"
+_zwpayload = b'{"time":1700000000000,"value":19.5}'
+
+def _zwtemp():
+    from thermlib import zwavejs2mqtt
+    zwavejs2mqtt._client = FakeMqttClient()
+    temp = zwavejs2mqtt.Temp({"mqttclient": {"clientid": "bench", "host": "localhost"}},
+                             {"nodeid": 8, "endpoint": 0, "property_current": "Air_temperature"})
+    return zwavejs2mqtt, temp
+
+@bench("zwave.ingest")
+def _():
+    zwavejs2mqtt, temp = _zwtemp()
+    message = FakeMqttMessage(_zwtopic, _zwpayload)
+    return lambda: zwavejs2mqtt._on_message(None, None, message)
+
+@bench("zwave.current")
+def _():
+    zwavejs2mqtt, temp = _zwtemp()
+    zwavejs2mqtt._on_message(None, None, FakeMqttMessage(_zwtopic, _zwpayload))
+    return temp.current
+
+# Message stream for the dispatch benchmarks: if THERMBENCH_ZWSTREAM is set, it names a file with
+# one recorded [topic, payload] JSON array per line, else we generate messages for ntopics
+# temperature sensors, plus as many messages for topics nobody registered (other properties of
+# the same nodes), as seen with a wildcard subscription.
+def _zwstream(ntopics):
+    fn = os.environ.get("THERMBENCH_ZWSTREAM")
+    if fn:
+        with open(fn, "r") as f:
+            return [(t, p.encode("utf-8")) for t, p in [json.loads(l) for l in f if l.strip()]]
+    stream = []
+    for i in range(ntopics):
+        payload = ('{"time":1700000000000,"value":%.1f}' % (15.0 + (i % 100) / 10.0)).encode()
+        stream.append(("zwave/nodeID_%d/49/0/Air_temperature" % i, payload))
+        stream.append(("zwave/nodeID_%d/49/0/Humidity" % i, payload))
+    return stream
+
+def _zwdispatch(ntopics):
+    from thermlib import zwavejs2mqtt
+    stream = _zwstream(ntopics)
+    store = zwavejs2mqtt.ValueStore()
+    dispatcher = zwavejs2mqtt.Dispatcher(store)
+    client = FakeMqttClient()
+    for topic, payload in stream:
+        if topic.endswith("Air_temperature"):
+            dispatcher.register(client, topic, "zwave", 49)
+    messages = [FakeMqttMessage(t, p) for t, p in stream]
+    # One op is one message
+    state = {"i": 0}
+    n = len(messages)
+    def op():
+        message = messages[state["i"]]
+        state["i"] = (state["i"] + 1) % n
+        dispatcher.dispatch(message.topic, message.payload)
+    return op
+
+@bench("zwave.dispatch.10")
+def _():
+    return _zwdispatch(10)
+
+@bench("zwave.dispatch.100")
+def _():
+    return _zwdispatch(100)
+
+@bench("zwave.dispatch.1000")
+def _():
+    return _zwdispatch(1000)
+
+# The previous implementation stored the raw payload (decoding it for a debug message even when
+# not logging), and parsed it on every current() call. Kept for comparison.
+@bench("zwave.ingest.legacy")
+def _():
+    values = {}
+    message = FakeMqttMessage(_zwtopic, _zwpayload)
+    logger = logging.getLogger("legacy")
+    def op():
+        logger.debug("topic %s qos %s retain %s payload %s", message.topic, message.qos,
+                     message.retain, message.payload.decode("utf-8"))
+        values[message.topic] = message.payload
+    return op
+
+@bench("zwave.current.legacy")
+def _():
+    import datetime
+    values = {_zwtopic: _zwpayload}
+    logger = logging.getLogger("legacy")
+    def op():
+        data = json.loads(values[_zwtopic])
+        dt = datetime.datetime.fromtimestamp(data["time"]/1000)
+        logger.debug("Temp:%s value %f (%s)", _zwtopic, data["value"], dt)
+        return data["value"]
+    return op
+
+
+########## filters
+
+# A slowly varying temperature with noise and a few glitches (not first: a RateLimiter raises on a
+# glitch without a previous value), cycled through by the benchmarks
+def _filtersamples(n=1000):
+    import math
+    import random
+    rnd = random.Random(1)
+    samples = [20.0 + math.sin(i / 100.0) + rnd.gauss(0, 0.05) for i in range(n)]
+    for i in range(97, n, 97):
+        samples[i] = 85.0
+    return samples
+
+def _filterop(stage):
+    samples = _filtersamples()
+    state = {"i": 0, "t": 0.0}
+    n = len(samples)
+    def op():
+        i = state["i"]
+        state["i"] = (i + 1) % n
+        state["t"] += 60.0
+        return stage.update(samples[i], state["t"])
+    return op
+
+@bench("filter.median.5")
+def _():
+    from thermlib import filters
+    return _filterop(filters.MedianFilter(5))
+
+@bench("filter.median.101")
+def _():
+    from thermlib import filters
+    return _filterop(filters.MedianFilter(101))
+
+@bench("filter.ema")
+def _():
+    from thermlib import filters
+    return _filterop(filters.ExpSmoother(0.3))
+
+@bench("filter.kalman")
+def _():
+    from thermlib import filters
+    return _filterop(filters.KalmanFilter())
+
+@bench("filter.rate")
+def _():
+    from thermlib import filters
+    return _filterop(filters.RateLimiter(0.01, reject=(85.0,)))
+
+@bench("filter.chain")
+def _():
+    from thermlib import filters
+    return _filterop(filters.make_filter([{"type": "rate"}, {"type": "median", "window": 5},
+                                          {"type": "ema"}]))
+
+
+########## PID
+
+# One op computes the commands for all the zones: with n PID.PID objects, or with a PIDBank
+def _pidinputs(n):
+    return [18.0 + (i % 50) / 10.0 for i in range(n)]
+
+def _pidobjects(n):
+    from thermlib import PID
+    pids = [PID.PID(Kp=100.0, Ki=0.05, Kd=0.0, setpoint=20.0, output_limits=(0, 100),
+                    sample_time=None) for i in range(n)]
+    inputs = _pidinputs(n)
+    def op():
+        return [pid(x, 600.0) for pid, x in zip(pids, inputs)]
+    return op
+
+def _pidbank(n):
+    from thermlib import pidbank
+    bank = pidbank.PIDBank(n, Kp=100.0, Ki=0.05, Kd=0.0, setpoint=20.0, output_limits=(0, 100))
+    inputs = _pidinputs(n)
+    return lambda: bank.step(inputs, 600.0)
+
+@bench("pid.objects.1")
+def _():
+    return _pidobjects(1)
+
+@bench("pid.objects.100")
+def _():
+    return _pidobjects(100)
+
+@bench("pid.objects.1000")
+def _():
+    return _pidobjects(1000)
+
+@bench("pid.bank.1")
+def _():
+    return _pidbank(1)
+
+@bench("pid.bank.100")
+def _():
+    return _pidbank(100)
+
+@bench("pid.bank.1000")
+def _():
+    return _pidbank(1000)
+
+# Check that a PIDBank computes exactly the same outputs and components as PID.PID objects, with
+# random tunings, limits and proportional modes, over nsteps random inputs and time steps, with
+# some switches to manual mode and back. Returns the number of mismatches (printing the first
+# ones).
+def pidcheck(ncontrollers=50, nsteps=2000, seed=1):
+    import random
+    from thermlib import PID, pidbank
+    rnd = random.Random(seed)
+    bank = pidbank.PIDBank(ncontrollers)
+    pids = []
+    for k in range(ncontrollers):
+        tunings = (rnd.uniform(0, 200), rnd.uniform(0, 0.1), rnd.uniform(0, 50))
+        setpoint = rnd.uniform(15, 22)
+        limits = rnd.choice(((0, 100), (None, 100), (0, None), (None, None), (-50, 50)))
+        pom = rnd.random() < 0.3
+        pids.append(PID.PID(*tunings, setpoint=setpoint, sample_time=None, output_limits=limits,
+                            proportional_on_measurement=pom))
+        bank.set_tunings(k, *tunings)
+        bank.set_setpoint(k, setpoint)
+        bank.set_output_limits(k, limits)
+        bank.pom[k] = 1 if pom else 0
+    mismatches = 0
+    for step in range(nsteps):
+        for k in range(ncontrollers):
+            if rnd.random() < 0.002:
+                enabled = not pids[k].auto_mode
+                lastoutput = rnd.choice((None, rnd.uniform(-20, 120)))
+                pids[k].set_auto_mode(enabled, lastoutput)
+                bank.set_auto_mode(k, enabled, lastoutput)
+        inputs = [rnd.uniform(10, 25) for k in range(ncontrollers)]
+        dt = rnd.uniform(1, 1200)
+        outputs = bank.step(inputs, dt)
+        for k in range(ncontrollers):
+            expected = pids[k](inputs[k], dt)
+            if not pids[k].auto_mode:
+                continue
+            if outputs[k] != expected or bank.components(k) != pids[k].components:
+                mismatches += 1
+                if mismatches <= 10:
+                    print("pidcheck: step %d controller %d: bank %r %r, PID %r %r" %
+                          (step, k, outputs[k], bank.components(k), expected,
+                           pids[k].components))
+    print("pidcheck: %d controllers, %d steps, %d mismatches" %
+          (ncontrollers, nsteps, mismatches))
+    return mismatches
+
+
+########## Logging
+
+# One op is one logger.debug() call with a few arguments, with DEBUG enabled (except for
+# log.debug.disabled). The file is in /tmp, and the queue listener is stopped at exit.
+def _logop(name, conf):
+    import atexit
+    import logging.handlers
+    import queue
+    from thermlib import utils
+    conf = dict(conf)
+    conf["logfilename"] = "/tmp/thermbench_log_%d.txt" % os.getpid()
+    atexit.register(lambda: os.path.exists(conf["logfilename"]) and os.unlink(conf["logfilename"]))
+    logger = logging.getLogger("thermbench." + name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = utils.logfilehandler(conf)
+    if conf.get("logqueue"):
+        logqueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(logqueue, handler)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = utils.LazyQueueHandler(logqueue)
+    logger.addHandler(handler)
+    return lambda: logger.debug("PID: dt %.2f error %.2f proportional %.2f integral  %.2f",
+                                600.0, 0.5, 50.0, 12.5)
+
+@bench("log.debug.disabled")
+def _():
+    logger = logging.getLogger("thermbench.disabled")
+    logger.setLevel(logging.INFO)
+    return lambda: logger.debug("PID: dt %.2f error %.2f proportional %.2f integral  %.2f",
+                                600.0, 0.5, 50.0, 12.5)
+
+@bench("log.debug.sync")
+def _():
+    return _logop("sync", {})
+
+@bench("log.debug.queue")
+def _():
+    return _logop("queue", {"logqueue": 1})
+
+@bench("log.debug.queue.json")
+def _():
+    return _logop("json", {"logqueue": 1, "logformat": "json"})
+
+
+########## Metrics
+
+@bench("metrics.counter.inc")
+def _():
+    from thermlib import metrics
+    return metrics.Counter("bench_total", "bench", ["a"]).labels("x").inc
+
+@bench("metrics.histogram.observe")
+def _():
+    from thermlib import metrics
+    child = metrics.Histogram("bench_seconds", "bench", ["a"]).labels("x")
+    return lambda: child.observe(0.042)
+
+
+########## Setpoint schedule
+
+# Schedule with nentries transitions per day, all days different
+def _schedule(nentries):
+    from thermlib import schedule
+    days = {}
+    for d in range(7):
+        days[str(d)] = [["%02d:%02d" % divmod((i * 1440) // nentries, 60), 15.0 + (i + d) % 7]
+                        for i in range(nentries)]
+    return schedule, {"default": 16.0, "days": days, "week": [str(d) for d in range(7)]}
+
+@bench("schedule.get")
+def _():
+    schedule, config = _schedule(4)
+    getter = schedule.ScheduleGetter(config)
+    return getter.get
+
+@bench("schedule.lookup.1000")
+def _():
+    schedule, config = _schedule(1000)
+    sched = schedule.Schedule(config)
+    now = time.time()
+    state = {"i": 0}
+    def op():
+        state["i"] = (state["i"] + 317) % 86400
+        return sched.lookup(now + state["i"])
+    return op
+
+@bench("schedule.compile.1000")
+def _():
+    schedule, config = _schedule(1000)
+    sched = schedule.Schedule(config)
+    return sched.compile
+
+
+########## Staggered PWM
+
+# Minimal event loop with a virtual clock, enough for scheduler.ActuationScheduler. Time only moves
+# when running the timers.
+class VirtualLoop(object):
+    class Handle(object):
+        def __init__(self):
+            self.cancelled = False
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, start=0.0):
+        import heapq
+        self.heapq = heapq
+        self.now = start
+        self.timers = []
+        self.seq = 0
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        handle = VirtualLoop.Handle()
+        self.seq += 1
+        self.heapq.heappush(self.timers, (when, self.seq, handle, callback, args))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.now, callback, *args)
+
+    def run_until(self, end):
+        while self.timers and self.timers[0][0] <= end:
+            when, seq, handle, callback, args = self.heapq.heappop(self.timers)
+            if handle.cancelled:
+                continue
+            self.now = max(self.now, when)
+            callback(*args)
+        self.now = end
+
+# Relay counting the number of relays on at the same time
+class LoadRelay(object):
+    def __init__(self, load):
+        self.load = load
+        self.on = False
+    def turnon(self):
+        if not self.on:
+            self.on = True
+            self.load["on"] += 1
+            self.load["peak"] = max(self.load["peak"], self.load["on"])
+    def turnoff(self):
+        if self.on:
+            self.on = False
+            self.load["on"] -= 1
+
+def _pwmcommands(nzones, seed):
+    import random
+    rnd = random.Random(seed)
+    return [rnd.choice([0, rnd.uniform(5, 95), rnd.uniform(5, 40), 100]) for i in range(nzones)]
+
+# Run nzones relays for nperiods heating periods, with random commands changing every period for
+# a tenth of the zones. Returns (peak load, minimum possible peak for the commands, delayed
+# windows). If staggered is false, all the zones start heating at the period start, as
+# independent thermostats would.
+def pwmsim(nzones, nperiods=20, period=1800.0, staggered=True, seed=1):
+    import random
+    from thermlib import scheduler, pwm
+    rnd = random.Random(seed)
+    loop = VirtualLoop()
+    timers = scheduler.ActuationScheduler(loop)
+    load = {"on": 0, "peak": 0}
+    commands = _pwmcommands(nzones, seed)
+    pwmctl = pwm.StaggeredPWM(timers, period, 60)
+    for i, command in enumerate(commands):
+        pwmctl.addzone(i, LoadRelay(load), command)
+    minpeak = pwmctl.stats()["minpeak"]
+    if not staggered:
+        # No offsets: every zone counts as the first one
+        pwmctl.offset = lambda name: 0.0
+    pwmctl.run()
+    for n in range(nperiods):
+        loop.run_until((n + 0.5) * period)
+        for i in rnd.sample(range(nzones), max(1, nzones // 10)):
+            pwmctl.setcommand(i, rnd.uniform(0, 100))
+        minpeak = max(minpeak, pwmctl.stats()["minpeak"])
+        loop.run_until((n + 1) * period)
+    return load["peak"], minpeak, pwmctl.stats()["delayed"]
+
+def pwmsims():
+    for nzones in (10, 100, 500):
+        aligned = pwmsim(nzones, staggered=False)
+        start = time.perf_counter()
+        staggered = pwmsim(nzones)
+        elapsed = time.perf_counter() - start
+        print("%4d relays: peak concurrent load aligned %4d staggered %4d (minimum %4d) "
+              "delayed %d, %.2f S" % (nzones, aligned[0], staggered[0], staggered[1],
+                                      staggered[2], elapsed))
+
+def _pwmupdate(nzones):
+    from thermlib import scheduler, pwm
+    pwmctl = pwm.StaggeredPWM(scheduler.ActuationScheduler(VirtualLoop()), 1800, 60)
+    commands = _pwmcommands(nzones, 1)
+    for i, command in enumerate(commands):
+        pwmctl.addzone(i, LoadRelay({"on": 0, "peak": 0}), command)
+    state = {"i": 0}
+    # One op: change one zone's command and get the offset of another one
+    def op():
+        i = state["i"]
+        state["i"] = (i + 7) % nzones
+        pwmctl.setcommand(i, commands[(i + 3) % nzones])
+        return pwmctl.offset((i + nzones // 2) % nzones)
+    return op
+
+@bench("pwm.update.10")
+def _():
+    return _pwmupdate(10)
+
+@bench("pwm.update.100")
+def _():
+    return _pwmupdate(100)
+
+@bench("pwm.update.1000")
+def _():
+    return _pwmupdate(1000)
+
+
+########## State logger, configuration, sensors
+
+_tmpdir = None
+
+# Temporary directory for the benchmark files, removed at exit
+def _tmpname(name):
+    global _tmpdir
+    if _tmpdir is None:
+        import tempfile
+        _tmpdir = tempfile.TemporaryDirectory(prefix="thermbench-")
+    return os.path.join(_tmpdir.name, name)
+
+@bench("statelog.logstate")
+def _():
+    import thermlog
+    # period 0: every call writes a line, as when the log period has elapsed
+    datarepo = _tmpname("data")
+    os.mkdir(datarepo)
+    statelogger = thermlog.StateLogger(datarepo, period=0)
+    values = {"temp": 19.4567, "set": 20.0, "on": 1, "cmd": 42.123, "p": 54.321, "i": -12.345,
+              "d": 0.0}
+    return lambda: statelogger.logstate(dict(values))
+
+@bench("statelog.logstate.throttled")
+def _():
+    import thermlog
+    statelogger = thermlog.StateLogger("/nonexistent")
+    statelogger.last = time.time() + 3600
+    values = {"temp": 19.4567, "set": 20.0, "on": 1}
+    return lambda: statelogger.logstate(values)
+
+# Write a ConfSimple/ConfTree file with nvalues values in the root section, and the same values
+# in each of the sections
+def _conffile(name, nvalues, sections=()):
+    fn = _tmpname(name)
+    with open(fn, "w") as f:
+        print("# Benchmark configuration", file=f)
+        for sk in [""] + list(sections):
+            if sk:
+                print("[%s]" % sk, file=f)
+            for i in range(nvalues):
+                print("name%d = value %d with some text" % (i, i), file=f)
+    return fn
+
+@bench("conftree.parse")
+def _():
+    from thermlib import conftree
+    fn = _conffile("parse", 50, ["section%d" % i for i in range(5)])
+    return lambda: conftree.ConfSimple(fn)
+
+@bench("conftree.get")
+def _():
+    from thermlib import conftree
+    conf = conftree.ConfSimple(_conffile("get", 50))
+    return lambda: conf.get("name25")
+
+@bench("conftree.set")
+def _():
+    from thermlib import conftree
+    conf = conftree.ConfSimple(_conffile("set", 50), readonly=False)
+    return lambda: conf.set("localsetting", "19.5")
+
+# Look up a value set in the root section from a path 8 levels deep, without sections on the
+# way: walks all the ancestors.
+@bench("conftree.tree.getbin.deep")
+def _():
+    from thermlib import conftree
+    conf = conftree.ConfTree(_conffile("tree", 10, ["/other", "/other/sub"]))
+    sk = "".join(["/level%d" % i for i in range(8)]).encode("utf-8")
+    return lambda: conf.getbin(b"name5", sk)
+
+@bench("utils.config.load")
+def _():
+    from thermlib import utils
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "therm_config")
+    return lambda: utils.Config(fn)
+
+@bench("owif.id_ow")
+def _():
+    from thermlib import owif
+    ids = ["160008027D6BA410", "28-0300a2792076", "28.762079A20003"]
+    return lambda: [owif.id_ow(id) for id in ids]
+
+# owserver proxy returning a fixed temperature, as pyownet does (bytes, right aligned)
+class FakeOwProxy(object):
+    def read(self, path):
+        return b"     19.5625"
+    def write(self, path, data):
+        pass
+
+@bench("owif.readtemp")
+def _():
+    from thermlib import owif
+    conn = FakeOwProxy()
+    owid = owif.id_ow("28-0300a2792076")
+    return lambda: owif._readtemp(conn, owid)
+
+@bench("climcave.targetC")
+def _():
+    import climcave
+    return climcave.targetC
+
+
+##########
+# Run the benchmarks. The backend modules (paho, pyownet...) are only imported by the benchmarks
+# which use them, and these are skipped if a module is missing.
+def run(names):
+    results = {}
+    for name in sorted(_benchmarks.keys()):
+        if names and not [n for n in names if name.startswith(n)]:
+            continue
+        try:
+            op = _benchmarks[name]()
+        except ImportError as e:
+            print("%-30s skipped: %s" % (name, e))
+            continue
+        percall = measure(op)
+        results[name] = percall
+        print("%-30s %10.3f uS/op %12.0f op/S" % (name, percall * 1e6, 1.0 / percall))
+    return results
+
+
+def saveresults(fn, results):
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except Exception:
+        commit = None
+    data = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "machine": platform.machine(),
+            "results": results}
+    with open(fn, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+# Compare the results with the baseline ones, print the ratios, and return the names of the
+# benchmarks slower than the baseline by more than threshold.
+def compareresults(baseline, results, threshold=0.25):
+    slower = []
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            slower.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = "  faster"
+        print("%-30s %10.3f -> %10.3f uS/op %6.2fx%s" %
+              (name, baseline[name] * 1e6, results[name] * 1e6, ratio, flag))
+    return slower
+
+
+# Import each backend module in a fresh interpreter and report the time and the memory allocated
+# by the import (including the modules it pulls in). Modules which can't be imported here (missing
+# library or hardware) are reported as such.
+def importtimes():
+    import subprocess
+    from thermlib import sensorfact
+    code = """
+import sys, time, tracemalloc
+tracemalloc.start()
+start = time.perf_counter()
+try:
+    import %s
+except BaseException as e:
+    print("error %%s" %% e)
+    sys.exit(0)
+elapsed = time.perf_counter() - start
+print("%%f %%d" %% (elapsed, tracemalloc.get_traced_memory()[1]))
+"""
+    modules = sorted(set([t.partition(":")[0] for t in sensorfact._registry.values()
+                          if isinstance(t, str)]))
+    results = {}
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    for modname in modules:
+        out = subprocess.check_output([sys.executable, "-c", code % modname], cwd=srcdir,
+                                      stderr=subprocess.DEVNULL).decode("utf-8").strip()
+        if out.startswith("error"):
+            print("%-30s %s" % (modname, out))
+            continue
+        elapsed, memory = out.split()
+        results[modname] = (float(elapsed), int(memory))
+        print("%-30s %10.1f mS %10.0f kB" % (modname, 1000 * float(elapsed), int(memory) / 1024))
+    return results
+
+
+if __name__ == '__main__':
+    def perr(s):
+        print("%s"%s, file=sys.stderr)
+    def usage():
+        perr("Usage: thermbench.py [-l] [-i] [-p] [-e] [-o results.json] [-c baseline.json] "
+             "[-t threshold] [name ...]")
+        sys.exit(1)
+    # Benchmark with logging enabled at the default level, as the daemons normally run.
+    logging.basicConfig(level=logging.ERROR)
+    args = sys.argv[1:]
+    if args and args[0] == "-l":
+        for name in sorted(_benchmarks.keys()):
+            print(name)
+        sys.exit(0)
+    if args and args[0] == "-i":
+        importtimes()
+        sys.exit(0)
+    if args and args[0] == "-p":
+        pwmsims()
+        sys.exit(0)
+    if args and args[0] == "-e":
+        sys.exit(1 if pidcheck() else 0)
+    options = {"-o": None, "-c": None, "-t": "0.25"}
+    while args and args[0].startswith("-"):
+        if args[0] not in options or len(args) < 2:
+            usage()
+        options[args[0]] = args[1]
+        args = args[2:]
+    if [a for a in args if a.startswith("-")]:
+        usage()
+    try:
+        threshold = float(options["-t"])
+    except ValueError:
+        usage()
+    baseline = None
+    if options["-c"]:
+        with open(options["-c"], "r") as f:
+            baseline = json.load(f)["results"]
+    results = run(args)
+    if options["-o"]:
+        saveresults(options["-o"], results)
+    if baseline is not None:
+        print()
+        slower = compareresults(baseline, results, threshold)
+        if slower:
+            print("%d benchmark(s) slower by more than %d%%: %s" %
+                  (len(slower), 100 * threshold, " ".join(slower)))
+            sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,162 @@
+# Switch wrapper remembering the confirmed state of the device, so that commands which would not
+# change anything are not sent. The control loops call turnoff() quite freely (at init, and for
+# every period with a zero command), and for some devices (e.g. zwave) each command is a network
+# request followed by a confirmation wait.
+#
+# - The device state is read again every reconcileinterval seconds (if a command comes in), to
+#   catch changes made behind our back (e.g. the relay was switched manually, or a device reset).
+#   If the state differs from what was last asked, the command is sent again.
+# - If coalesceseconds is set and we are running in an asyncio loop, the commands are not sent
+#   immediately but after this delay, and only the last one is used: a quick on/off/on sequence
+#   results in at most one device command.
+# - current() returns what the device current() returns (and raises its errors), from the cache
+#   when possible.
+# - The command counts are exported as metrics (therm_cachedswitch_*).
+
+import time
+import asyncio
+import logging
+
+from thermlib import metrics
+
+logger = logging.getLogger(__name__)
+
+_commands = metrics.counter("therm_cachedswitch_commands_total",
+                            "Switch commands asked to the cached switches", ["result"])
+_sent = _commands.labels("sent")
+_skipped = _commands.labels("skipped")
+_coalesced = _commands.labels("coalesced")
+_errors = _commands.labels("error")
+_reconciles = metrics.counter("therm_cachedswitch_reconciles_total",
+                              "Device state reads by the cached switches")
+_drifts = metrics.counter("therm_cachedswitch_drifts_total",
+                          "Device states found different from the expected one")
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class CachedSwitch(object):
+    def __init__(self, switch, reconcileinterval=600, coalesceseconds=0):
+        self.switch = switch
+        self.reconcileinterval = reconcileinterval
+        self.coalesceseconds = coalesceseconds
+        # Confirmed device state: None if unknown, else True/False
+        self.known = None
+        # Value last returned by the device current(), or which it should now return
+        self.knownvalue = None
+        # Last state asked by our caller
+        self.desired = None
+        self.lastreconcile = time.monotonic()
+        self.pending = None
+        # Statistics
+        self.requested = 0
+        self.sent = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.reconciles = 0
+        self.drifts = 0
+        self.errors = 0
+
+    def turnon(self):
+        return self.set(True)
+
+    def turnoff(self):
+        return self.set(False)
+
+    def set(self, state):
+        state = bool(state)
+        self.requested += 1
+        self.desired = state
+        if self.coalesceseconds > 0:
+            loop = _running_loop()
+            if loop:
+                if self.pending is None:
+                    self.pending = loop.call_later(self.coalesceseconds, self._flush)
+                else:
+                    self.coalesced += 1
+                    _coalesced.inc()
+                return True
+        return self._apply()
+
+    def _flush(self):
+        self.pending = None
+        try:
+            self._apply()
+        except Exception:
+            logger.exception("CachedSwitch: could not set switch to %s", self.desired)
+
+    def _apply(self):
+        if time.monotonic() > self.lastreconcile + self.reconcileinterval:
+            self.reconcile()
+        if self.known is not None and self.known == self.desired:
+            self.skipped += 1
+            _skipped.inc()
+            return True
+        try:
+            if self.desired:
+                self.switch.turnon()
+            else:
+                self.switch.turnoff()
+        except Exception:
+            self.errors += 1
+            _errors.inc()
+            self.known = None
+            raise
+        self.sent += 1
+        _sent.inc()
+        self.known = self.desired
+        # We don't know how the device represents its state (1/0, True/False...)
+        self.knownvalue = None
+        return True
+
+    # Read the actual device state and update ours. Errors are raised.
+    def _read(self):
+        self.reconciles += 1
+        _reconciles.inc()
+        self.lastreconcile = time.monotonic()
+        try:
+            value = self.switch.current()
+        except Exception:
+            self.known = None
+            raise
+        actual = bool(value)
+        if self.known is not None and actual != self.known:
+            self.drifts += 1
+            _drifts.inc()
+            logger.warning("CachedSwitch: device state %s differs from expected %s",
+                           actual, self.known)
+        self.known = actual
+        self.knownvalue = value
+        return value
+
+    # Same as _read(), logging the errors and returning None.
+    def reconcile(self):
+        try:
+            return bool(self._read())
+        except Exception as e:
+            logger.error("CachedSwitch: could not read switch state: %s", e)
+            return None
+
+    # Return the value from the device current(), reading it only if we don't know it, or if
+    # reconcileinterval is over. Read errors are the device's ones.
+    def current(self):
+        if self.knownvalue is None or \
+           time.monotonic() > self.lastreconcile + self.reconcileinterval:
+            return self._read()
+        return self.knownvalue
+
+    # Compat
+    def state(self):
+        return self.current()
+
+    def stats(self):
+        return {"requested": self.requested, "sent": self.sent, "skipped": self.skipped,
+                "coalesced": self.coalesced, "reconciles": self.reconciles,
+                "drifts": self.drifts, "errors": self.errors}
+
+    def __getattr__(self, name):
+        return getattr(self.switch, name)
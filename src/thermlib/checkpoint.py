@@ -0,0 +1,43 @@
+# Saving and restoring some program state across restarts, as a small JSON file.
+#
+# The file is written atomically (temporary file, fsync, rename), so that a crash or power cut
+# during the write leaves either the previous or the new version, never a truncated one.
+
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def save_state(path, data):
+    data = dict(data)
+    data["savetime"] = time.time()
+    tmppath = path + ".tmp"
+    try:
+        with open(tmppath, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except Exception as e:
+        logger.error("Could not save state to %s: %s", path, e)
+        return False
+    return True
+
+# Return the saved data if it exists and is less than maxage seconds old, else None.
+def load_state(path, maxage):
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error("Could not read state from %s: %s", path, e)
+        return None
+    age = time.time() - data.get("savetime", 0)
+    if age < 0 or age > maxage:
+        logger.info("State in %s is too old (%d S), not using it", path, age)
+        return None
+    return data
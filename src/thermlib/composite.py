@@ -0,0 +1,186 @@
+# Composite temperature sensor: aggregates several child sensors of any type (e.g. onewire + zwave
+# + sysfs) into a single value.
+#
+# The children are read in parallel, each with a timeout, and the value is computed as soon as
+# quorum children have answered, without waiting for the slow ones. A child which is only slower
+# than the quorum is left alone (its result is recorded when it arrives): it times out only if its
+# read lasts more than the timeout. A failing child is put aside for a while (with an increasing
+# delay), and only causes an error if too few children are left.
+#
+# Fusion methods:
+#  - mean, median: of the values received
+#  - weighted: weighted mean, using the "weights" config dict (child name -> weight, default 1)
+#  - first: the value from the first child in configuration order which answers. Later children
+#    are only used if the previous ones failed.
+
+import time
+import logging
+import statistics
+import concurrent.futures
+
+from thermlib import events
+
+logger = logging.getLogger(__name__)
+
+
+class _Child(object):
+    def __init__(self, name, sensor, weight):
+        self.name = name
+        self.sensor = sensor
+        self.weight = weight
+        self.future = None
+        # Time after which the current read is late (monotonic)
+        self.deadline = None
+        self.failures = 0
+        self.retrytime = 0
+
+
+class Temp(object):
+    def __init__(self, config, myconfig):
+        from thermlib import sensorfact
+        weights = myconfig.get("weights", {})
+        self.children = []
+        for name in myconfig["children"]:
+            self.children.append(_Child(name, sensorfact.make_temp(config, name),
+                                        float(weights.get(name, 1.0))))
+        self.fusion = myconfig.get("fusion", "median")
+        if self.fusion not in ("mean", "median", "weighted", "first"):
+            raise Exception("composite: unknown fusion method %s" % self.fusion)
+        self.quorum = int(myconfig.get("quorum", len(self.children) // 2 + 1))
+        if self.fusion == "first":
+            self.quorum = 1
+        self.timeout = float(myconfig.get("timeout", 10))
+        # Max delay before retrying a failed child
+        self.maxretrydelay = float(myconfig.get("maxretrydelay", 600))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.children))
+        # Per-child result of the last read: name -> {"value", "ok", "error", "time", "degraded"}
+        self.quality = {}
+
+    def _failed(self, child, error):
+        child.failures += 1
+        delay = min(self.maxretrydelay, 2 ** min(child.failures, 16))
+        child.retrytime = time.monotonic() + delay
+        logger.error("composite: child %s failed (%s), retrying in %d S", child.name, error,
+                     delay)
+        self.quality[child.name] = {"value": None, "ok": False, "error": str(error),
+                                    "time": time.time(), "degraded": True}
+
+    def _succeeded(self, child, value):
+        if child.failures:
+            logger.info("composite: child %s is back", child.name)
+        child.failures = 0
+        self.quality[child.name] = {"value": value, "ok": True, "error": None,
+                                    "time": time.time(), "degraded": False}
+
+    # Start reads on the healthy children which are not still busy with a previous one.
+    def _start(self):
+        now = time.monotonic()
+        running = {}
+        for child in self.children:
+            if child.future is not None:
+                if not child.future.done():
+                    if now < child.deadline:
+                        # Slower than the quorum last time, but not late yet: let it finish
+                        continue
+                    # Still stuck in the previous read
+                    self.quality.setdefault(child.name, {"value": None, "ok": False,
+                                                         "error": "busy", "time": time.time()})
+                    self.quality[child.name]["degraded"] = True
+                    continue
+                child.future = None
+            if child.failures and now < child.retrytime:
+                continue
+            child.future = self.executor.submit(child.sensor.current)
+            child.deadline = now + self.timeout
+            running[child.future] = child
+        return running
+
+    # Result of a read which finished after current() returned (called from the executor thread)
+    def _late(self, child, future):
+        if child.future is not future:
+            return
+        child.future = None
+        try:
+            value = future.result()
+        except Exception as e:
+            self._failed(child, e)
+            return
+        self._succeeded(child, value)
+
+    def _done(self, results):
+        if self.fusion == "first":
+            # Results are only usable if all the previous children are out
+            for child in self.children:
+                if child.name in results:
+                    return True
+                if child.future is not None and not child.future.done():
+                    return False
+            return bool(results)
+        return len(results) >= self.quorum
+
+    def _fuse(self, results):
+        values = [results[c.name] for c in self.children if c.name in results]
+        if self.fusion == "mean":
+            return sum(values) / len(values)
+        elif self.fusion == "median":
+            return statistics.median(values)
+        elif self.fusion == "weighted":
+            children = [c for c in self.children if c.name in results]
+            return sum([c.weight * results[c.name] for c in children]) / \
+                sum([c.weight for c in children])
+        else:
+            return values[0]
+
+    def current(self):
+        running = self._start()
+        results = {}
+        deadline = time.monotonic() + self.timeout
+        pending = set(running.keys())
+        while pending and not self._done(results):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = concurrent.futures.wait(
+                pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                child = running[future]
+                child.future = None
+                try:
+                    value = future.result()
+                except Exception as e:
+                    self._failed(child, e)
+                    continue
+                self._succeeded(child, value)
+                results[child.name] = value
+        # Children still reading: they timed out if their read is over its deadline, else they are
+        # just slower than the quorum, and their result is recorded when it arrives.
+        now = time.monotonic()
+        for future in pending:
+            child = running[future]
+            if now >= child.deadline:
+                self.quality[child.name] = {"value": None, "ok": False, "error": "timeout",
+                                            "time": time.time(), "degraded": True}
+            else:
+                future.add_done_callback(lambda f, child=child: self._late(child, f))
+        if not results:
+            raise Exception("composite: no child sensor answered")
+        if len(results) < self.quorum:
+            logger.warning("composite: only %d answers for a quorum of %d", len(results),
+                           self.quorum)
+        value = self._fuse(results)
+        logger.debug("composite: %s -> %s", results, value)
+        return value
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for child in self.children:
+            close = getattr(child.sensor, "close", None)
+            if close:
+                close()
+
+    def subscribe(self, callback):
+        pushed = False
+        for child in self.children:
+            if events.subscribe(child.sensor, callback):
+                pushed = True
+        return pushed
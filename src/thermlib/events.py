@@ -0,0 +1,59 @@
+# Event-driven control support: sensors which receive pushed updates (e.g. zwavejs2mqtt) let
+# the controller know through a Trigger, which runs a callback on the asyncio loop.
+#
+# The trigger is debounced (a burst of updates results in a single run, debounce seconds after the
+# first one) and rate-limited (never more than one run every mininterval seconds). fire() can be
+# called from any thread.
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Trigger(object):
+    def __init__(self, loop, callback, debounce=1.0, mininterval=10.0):
+        self.loop = loop
+        self.callback = callback
+        self.debounce = debounce
+        self.mininterval = mininterval
+        self.handle = None
+        self.lastrun = None
+        # Statistics
+        self.fired = 0
+        self.runs = 0
+
+    def fire(self, *args):
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        self.fired += 1
+        if self.handle is not None:
+            return
+        delay = self.debounce
+        if self.lastrun is not None:
+            delay = max(delay, self.lastrun + self.mininterval - time.monotonic())
+        self.handle = self.loop.call_later(delay, self._run)
+
+    def _run(self):
+        self.handle = None
+        self.lastrun = time.monotonic()
+        self.runs += 1
+        try:
+            self.callback()
+        except Exception:
+            logger.exception("Trigger callback failed")
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+# Subscribe callback to the updates from sensor. Returns False if the sensor does not push its
+# values, in which case the caller has to poll.
+def subscribe(sensor, callback):
+    subscribe = getattr(sensor, "subscribe", None)
+    if subscribe is None:
+        return False
+    return subscribe(callback)
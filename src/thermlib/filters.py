@@ -0,0 +1,205 @@
+# Streaming filters for sensor values, to be inserted between a sensor and the controller. A glitch
+# reading (e.g. 85C from a DS18B20 power-on reset) must not drive the command.
+#
+# Each stage has an update(value, now) method taking a raw value and the sample time (monotonic
+# seconds) and returning the filtered value. The stages keep a fixed amount of state and do not
+# allocate memory per sample. A FilterChain runs several stages in sequence.
+#
+# The configuration is a list of stages, e.g.:
+#   "filters": [{"type": "rate", "maxrate": 0.01},
+#               {"type": "median", "window": 5},
+#               {"type": "ema", "alpha": 0.3}]
+
+import time
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Rolling median over the last window samples. We keep the samples both in arrival order (ring
+# buffer) and sorted. Each update finds the oldest value and the new value's place by bisection
+# (O(log w)) and shifts the sorted list in place: for the window sizes used with sensors this is
+# faster in Python than heaps or skip lists, and no memory is allocated once the window is full.
+class MedianFilter(object):
+    def __init__(self, window=5):
+        if window < 1:
+            raise ValueError("MedianFilter: window must be at least 1")
+        self.window = window
+        self.ring = [0.0] * window
+        self.sorted = []
+        self.pos = 0
+
+    def update(self, value, now=None):
+        srt = self.sorted
+        if len(srt) == self.window:
+            old = self.ring[self.pos]
+            del srt[bisect.bisect_left(srt, old)]
+        self.ring[self.pos] = value
+        self.pos = (self.pos + 1) % self.window
+        bisect.insort(srt, value)
+        n = len(srt)
+        if n & 1:
+            return srt[n >> 1]
+        return (srt[(n >> 1) - 1] + srt[n >> 1]) / 2.0
+
+    def reset(self):
+        self.sorted = []
+        self.pos = 0
+
+
+# Exponential moving average. alpha is the weight of the new sample (0-1).
+class ExpSmoother(object):
+    def __init__(self, alpha=0.3):
+        if not 0 < alpha <= 1:
+            raise ValueError("ExpSmoother: alpha must be in ]0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value, now=None):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+# Scalar Kalman filter for a slowly varying value. q is the process noise (variance of the change
+# per second), r the measurement noise variance.
+class KalmanFilter(object):
+    def __init__(self, q=1e-5, r=0.01):
+        self.q = q
+        self.r = r
+        self.value = None
+        self.p = 1.0
+        self.last = None
+
+    def update(self, value, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.value is None:
+            self.value = value
+            self.p = self.r
+        else:
+            dt = now - self.last if now > self.last else 1.0
+            p = self.p + self.q * dt
+            k = p / (p + self.r)
+            self.value += k * (value - self.value)
+            self.p = (1 - k) * p
+        self.last = now
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+# Rejects the samples which are out of [minvalue, maxvalue], equal to one of the reject values
+# (85.0 is the DS18B20 power-on value), or changing faster than maxrate units per second from the
+# last accepted sample. A rejected sample is replaced by the last accepted value, or raises an
+# exception if there is none yet (the caller then handles it as a read error). After maxrejects
+# consecutive rejections, the new level is accepted: this was not a glitch.
+class RateLimiter(object):
+    def __init__(self, maxrate=0.01, minvalue=None, maxvalue=None, reject=(), maxrejects=5):
+        self.maxrate = maxrate
+        self.minvalue = minvalue
+        self.maxvalue = maxvalue
+        self.reject = tuple(reject)
+        self.maxrejects = maxrejects
+        self.value = None
+        self.last = None
+        self.rejects = 0
+        # Statistics
+        self.rejected = 0
+
+    def update(self, value, now=None):
+        if now is None:
+            now = time.monotonic()
+        bad = value in self.reject or \
+            (self.minvalue is not None and value < self.minvalue) or \
+            (self.maxvalue is not None and value > self.maxvalue)
+        if not bad and self.value is not None and self.maxrate:
+            # Allow at least one second worth of change
+            dt = now - self.last if now - self.last > 1.0 else 1.0
+            bad = abs(value - self.value) > self.maxrate * dt
+            if bad and self.rejects >= self.maxrejects:
+                logger.info("RateLimiter: accepting new level %s after %d rejections",
+                            value, self.rejects)
+                bad = False
+        if bad:
+            self.rejects += 1
+            self.rejected += 1
+            logger.debug("RateLimiter: rejected %s (last %s)", value, self.value)
+            if self.value is None:
+                raise Exception("RateLimiter: rejected %s, no previous value" % value)
+            return self.value
+        self.rejects = 0
+        self.value = value
+        self.last = now
+        return value
+
+    def reset(self):
+        self.value = None
+        self.rejects = 0
+
+
+class FilterChain(object):
+    def __init__(self, stages):
+        self.stages = stages
+
+    def update(self, value, now=None):
+        if now is None:
+            now = time.monotonic()
+        for stage in self.stages:
+            value = stage.update(value, now)
+            if value is None:
+                return None
+        return value
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+
+_types = {
+    "median": lambda c: MedianFilter(int(c.get("window", 5))),
+    "ema": lambda c: ExpSmoother(float(c.get("alpha", 0.3))),
+    "kalman": lambda c: KalmanFilter(float(c.get("q", 1e-5)), float(c.get("r", 0.01))),
+    "rate": lambda c: RateLimiter(float(c.get("maxrate", 0.01)), c.get("min"), c.get("max"),
+                                  c.get("reject", (85.0,)), int(c.get("maxrejects", 5))),
+}
+
+# Build a filter chain from a list of stage configurations
+def make_filter(stagesconfig):
+    stages = []
+    for stageconfig in stagesconfig:
+        tp = stageconfig["type"]
+        if tp not in _types:
+            raise Exception("Unknown filter type %s" % tp)
+        stages.append(_types[tp](stageconfig))
+    return FilterChain(stages)
+
+
+# Wraps a sensor object, filtering the values returned by current(). Other attributes are
+# forwarded to the sensor. If the sensor tells the time of its sample (sensorcache.CachedSensor),
+# a sample is only fed to the filters once: cache hits return the last filtered value.
+class FilteredSensor(object):
+    def __init__(self, sensor, filterchain):
+        self.sensor = sensor
+        self.filter = filterchain
+        self.sampletime = None
+        self.value = None
+
+    def current(self):
+        value = self.sensor.current()
+        sampletime = getattr(self.sensor, "sampletime", None)
+        if sampletime is not None and sampletime == self.sampletime:
+            return self.value
+        self.value = self.filter.update(value, time.monotonic())
+        self.sampletime = sampletime
+        return self.value
+
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
@@ -11,12 +11,18 @@ import subprocess
 import sys
 import os
 import glob
+import time
 
 import thermlib.utils
 from thermlib import conftree
+from thermlib import metrics
 
 logger = logging.getLogger(__name__)
 
+_gitseconds = metrics.histogram("therm_git_seconds", "Git command duration", ["command"],
+                                buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+_giterrors = metrics.counter("therm_git_errors_total", "Failed git commands", ["command"])
+
 class Gitele(object):
     def __init__(self, conf):
         self.conf = conf
@@ -47,9 +53,11 @@ class Gitele(object):
         return self.conf
 
     def _try_run_git(self, cmd, read_output = False):
+        command = cmd[0]
         cmd = self.gitcmd + cmd
+        start = time.monotonic()
         try:
-            logger.info("gitele: running: [%s]" % cmd)
+            logger.info("gitele: running: %s", cmd)
             output = "OK"
             if read_output:
                 output = subprocess.check_output(cmd)
@@ -57,14 +65,17 @@ class Gitele(object):
                 subprocess.check_call(cmd)
             return output
         except Exception as e:
+            _giterrors.labels(command).inc()
             logger.exception("git command failed: %s", cmd)
             return False
+        finally:
+            _gitseconds.labels(command).observe(time.monotonic() - start)
     
     def _readdata(self, path):
         try:
             return conftree.ConfSimple(path, False, False)
         except:
-            logger.exception("Could not read %s" % path)
+            logger.exception("Could not read %s", path)
             return None
 
     def pull(self):
@@ -88,7 +99,7 @@ class Gitele(object):
             logger.debug("gitele push: repo is unmodified")
             return
         else:
-            logger.debug("MODIFIED [%s]" % modified)
+            logger.debug("MODIFIED [%s]", modified)
         if not self._try_run_git(['add', '.']):
             return
         if not self._try_run_git(['commit', '-q', '-m', 'n']):
@@ -117,7 +128,7 @@ class Gitele(object):
         return result
     def action_confirm_done(self, seqnum, code):
         aname = self._actname(seqnum)
-        logger.info("action_confirm_done: %s" % aname)
+        logger.info("action_confirm_done: %s", aname)
         fn = os.path.join(self.datarepo, aname)
         self._try_run_git(['rm', '-f', fn])
 
@@ -0,0 +1,138 @@
+# Monitoring of an asyncio loop: lag, callback durations, and the stacks of the slow callbacks.
+#
+# - A probe scheduled every interval seconds measures how late the loop runs it (loop lag).
+# - Callbacks wrapped with wrap() have their durations recorded, by name.
+# - A watchdog thread checks the running wrapped callback. When one has been running for more
+#   than slowthreshold seconds, the stack of the loop thread is captured: this shows the call
+#   which is blocking the loop (file write, git pull, sleep...), while it is blocking.
+#
+# The statistics are exported as metrics, and summary() returns a text report (also served on the
+# metrics HTTP server as /loop).
+
+import sys
+import time
+import logging
+import threading
+import traceback
+import collections
+
+from thermlib import metrics
+
+logger = logging.getLogger(__name__)
+
+_lagseconds = metrics.histogram("therm_loop_lag_seconds", "Event loop lag", ["loop"])
+_laglast = metrics.gauge("therm_loop_lag_last_seconds", "Last measured event loop lag", ["loop"])
+_callbackseconds = metrics.histogram("therm_callback_seconds", "Loop callback duration",
+                                     ["callback"])
+_slowcallbacks = metrics.counter("therm_slow_callbacks_total", "Loop callbacks over the threshold",
+                                 ["callback"])
+
+
+class _CallbackStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.histogram = _callbackseconds.labels(name)
+        self.slowcounter = _slowcallbacks.labels(name)
+
+
+class LoopMonitor(object):
+    def __init__(self, loop, interval=1.0, slowthreshold=0.1, name="main", maxslow=20):
+        self.loop = loop
+        self.interval = interval
+        self.slowthreshold = slowthreshold
+        self.name = name
+        self.lagseconds = _lagseconds.labels(name)
+        self.laglast = _laglast.labels(name)
+        self.lagmax = 0.0
+        self.lagcount = 0
+        self.lagtotal = 0.0
+        self.callbacks = {}
+        # Last slow callbacks: (time, name, duration, stack text)
+        self.slow = collections.deque(maxlen=maxslow)
+        # Running wrapped callbacks (nested calls possible): [name, start, stack]
+        self.running = []
+        self.loopthread = None
+        self.stopped = threading.Event()
+        self.watchdog = None
+
+    def start(self):
+        self.loopthread = threading.get_ident()
+        self.loop.call_soon(self._probe, self.loop.time())
+        self.watchdog = threading.Thread(target=self._watch, name="loopmon", daemon=True)
+        self.watchdog.start()
+        metrics.addpage("/loop", self.summary)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _probe(self, expected):
+        now = self.loop.time()
+        lag = max(0.0, now - expected)
+        self.lagseconds.observe(lag)
+        self.laglast.set(lag)
+        self.lagcount += 1
+        self.lagtotal += lag
+        if lag > self.lagmax:
+            self.lagmax = lag
+        if not self.stopped.is_set():
+            self.loop.call_at(now + self.interval, self._probe, now + self.interval)
+
+    # Return a function calling func and recording its duration under name
+    def wrap(self, name, func):
+        stats = self.callbacks.setdefault(name, _CallbackStats(name))
+        def wrapper(*args, **kwargs):
+            entry = [name, time.monotonic(), None]
+            self.running.append(entry)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.running.pop()
+                duration = time.monotonic() - entry[1]
+                stats.count += 1
+                stats.total += duration
+                stats.histogram.observe(duration)
+                if duration > stats.max:
+                    stats.max = duration
+                if duration > self.slowthreshold:
+                    stats.slow += 1
+                    stats.slowcounter.inc()
+                    self.slow.append((time.time(), name, duration, entry[2]))
+                    logger.warning("Slow loop callback %s: %.3f S%s", name, duration,
+                                   "\n" + entry[2] if entry[2] else "")
+        return wrapper
+
+    # Watchdog thread: capture the loop thread stack once per slow callback call
+    def _watch(self):
+        period = max(0.01, self.slowthreshold / 2)
+        while not self.stopped.wait(period):
+            running = self.running
+            if not running:
+                continue
+            try:
+                entry = running[-1]
+            except IndexError:
+                continue
+            if entry[2] is None and time.monotonic() - entry[1] > self.slowthreshold:
+                frame = sys._current_frames().get(self.loopthread)
+                if frame is not None:
+                    entry[2] = "".join(traceback.format_stack(frame))
+
+    def summary(self):
+        lines = ["Loop %s: lag mean %.4f S max %.4f S (%d probes)" %
+                 (self.name, self.lagtotal / self.lagcount if self.lagcount else 0.0,
+                  self.lagmax, self.lagcount)]
+        lines.append("%-20s %8s %10s %10s %6s" % ("callback", "count", "mean S", "max S", "slow"))
+        for name in sorted(self.callbacks.keys()):
+            st = self.callbacks[name]
+            lines.append("%-20s %8d %10.4f %10.4f %6d" %
+                         (name, st.count, st.total / st.count if st.count else 0.0, st.max,
+                          st.slow))
+        for tm, name, duration, stack in self.slow:
+            lines.append("")
+            lines.append("Slow %s at %s: %.3f S" % (name, time.ctime(tm), duration))
+            lines.append(stack or "(no stack captured)")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,249 @@
+# Metrics for the daemons: counters, gauges and histograms with fixed buckets, exposed in the
+# Prometheus text format, over HTTP on localhost and/or as a periodically written file.
+#
+# Usage: declare the metric at module level, and bind the label values once, outside of the hot
+# path:
+#   _readseconds = metrics.histogram("therm_sensor_read_seconds", "Sensor read time", ["backend"])
+#   _owreadseconds = _readseconds.labels("owfs")
+#   ...
+#   _owreadseconds.observe(elapsed)
+#
+# Updates are plain attribute operations, without locks: each metric child is normally updated
+# from a single thread, and the exposition may see a histogram in the middle of an update, which
+# does not matter for monitoring.
+
+import os
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Default buckets (seconds), suited for device and I/O latencies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labelstring(labelnames, values):
+    if not labelnames:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                           for n, v in zip(labelnames, values)]) + "}"
+
+def _fmt(value):
+    if isinstance(value, int):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _CounterChild(object):
+    __slots__ = ("value",)
+    def __init__(self):
+        self.value = 0.0
+    def inc(self, amount=1.0):
+        self.value += amount
+
+class _GaugeChild(object):
+    __slots__ = ("value",)
+    def __init__(self):
+        self.value = 0.0
+    def set(self, value):
+        self.value = value
+    def inc(self, amount=1.0):
+        self.value += amount
+    def dec(self, amount=1.0):
+        self.value -= amount
+
+class _HistogramChild(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket, plus the +Inf one
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric(object):
+    kind = None
+    def __init__(self, name, helptext, labelnames=()):
+        self.name = name
+        self.helptext = helptext
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._newchild()
+
+    # Return the child for the label values. Keep it instead of calling this in hot paths.
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError("metrics: %s needs labels %s" % (self.name, self.labelnames))
+        values = tuple([str(v) for v in values])
+        child = self.children.get(values)
+        if child is None:
+            # setdefault() is atomic: concurrent callers get the same child
+            child = self.children.setdefault(values, self._newchild())
+        return child
+
+    def _samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, _labelstring(self.labelnames, values), child.value
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.helptext),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self._samples():
+            lines.append("%s%s %s" % (name, labels, _fmt(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+    def _newchild(self):
+        return _CounterChild()
+    def inc(self, amount=1.0):
+        self.children[()].inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+    def _newchild(self):
+        return _GaugeChild()
+    def set(self, value):
+        self.children[()].set(value)
+
+class Histogram(_Metric):
+    kind = "histogram"
+    def __init__(self, name, helptext, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, helptext, labelnames)
+    def _newchild(self):
+        return _HistogramChild(self.buckets)
+    def observe(self, value):
+        self.children[()].observe(value)
+    def _samples(self):
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            counts = list(child.counts)
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", \
+                    _labelstring(self.labelnames + ("le",), values + (_fmt(bound),)), cumulative
+            labels = _labelstring(self.labelnames, values)
+            yield self.name + "_sum", labels, child.sum
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, helptext, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, helptext, labelnames, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise Exception("metrics: %s already registered as a %s" % (name, metric.kind))
+            return metric
+
+    # The metrics may be registered by other threads while we run (e.g. a module imported late):
+    # work on a copy of the list.
+    def expose(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Get or create metrics in the default registry
+def counter(name, helptext, labelnames=()):
+    return REGISTRY._get(Counter, name, helptext, labelnames)
+
+def gauge(name, helptext, labelnames=()):
+    return REGISTRY._get(Gauge, name, helptext, labelnames)
+
+def histogram(name, helptext, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY._get(Histogram, name, helptext, labelnames, buckets=buckets)
+
+def expose():
+    return REGISTRY.expose()
+
+
+# Write the metrics to a file (atomically), e.g. for the node exporter textfile collector.
+def snapshot(path):
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as f:
+        f.write(expose())
+    os.replace(tmppath, path)
+
+
+_server = None
+_snapshotter = None
+# Other text pages served with the metrics: path -> function returning the text
+_pages = {"/": expose, "/metrics": expose}
+
+def addpage(path, func):
+    _pages[path] = func
+
+# Serve the metrics on http://host:port/metrics, from a daemon thread.
+def serve(port, host="127.0.0.1"):
+    global _server
+    import http.server
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            func = _pages.get(self.path)
+            if func is None:
+                self.send_error(404)
+                return
+            data = func().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        def log_message(self, format, *args):
+            logger.debug("metrics http: " + format, *args)
+    _server = http.server.ThreadingHTTPServer((host, port), Handler)
+    _server.daemon_threads = True
+    thread = threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return _server
+
+# Write a snapshot file every interval seconds, from a daemon thread.
+def snapshots(path, interval=60):
+    global _snapshotter
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            try:
+                snapshot(path)
+            except Exception as e:
+                logger.error("Could not write metrics snapshot %s: %s", path, e)
+    _snapshotter = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+    _snapshotter.start()
+    return stop
+
+# Start the exposition from the configuration: metricsport (HTTP server on localhost),
+# metricsfile and metricsinterval (snapshot file). Nothing is started if they are not set.
+def setup(conf):
+    port = conf.get("metricsport")
+    if port:
+        try:
+            serve(int(port))
+        except Exception as e:
+            logger.error("Could not start the metrics server on port %s: %s", port, e)
+    path = conf.get("metricsfile")
+    if path:
+        snapshots(path, float(conf.get("metricsinterval") or 60))
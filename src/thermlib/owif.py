@@ -6,16 +6,173 @@
 from pyownet import protocol
 import logging
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from thermlib import metrics
 
 logger = logging.getLogger(__name__)
 
+_readseconds = metrics.histogram("therm_sensor_read_seconds", "Sensor read time",
+                                 ["backend"]).labels("owfs")
+_readerrors = metrics.counter("therm_sensor_read_errors_total", "Sensor read errors",
+                              ["backend"]).labels("owfs")
+
 host = 'localhost'
 port = 4304
-try:
-    owproxy = protocol.proxy(host=host, port=port)
-except Exception as e:
-    logger.exception("protocol.proxy(%s,%d) failed", host, port)
-    raise e
+
+# Connection manager for one owserver. We keep persistent (keep-alive) pyownet proxies, which
+# avoids a TCP connection setup for every read. pyownet persistent proxies can't be shared between
+# threads, so each thread gets its own one. If owserver goes away (e.g. restarted), the proxy is
+# dropped and we try to reconnect on the next access, with an exponential backoff so that we do
+# not hammer a dead server. The list of devices on the bus is enumerated at connection time and
+# cached.
+class OwConnection(object):
+    def __init__(self, host=host, port=port, minbackoff=1.0, maxbackoff=30.0):
+        self.host = host
+        self.port = port
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.backoff = minbackoff
+        self.nextattempt = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Incremented by reset(): the proxies from a previous generation are not used any more
+        self.generation = 0
+        self.devices = set()
+        # Statistics
+        self.connected = False
+        self.connects = 0
+        self.reconnects = 0
+        self.reads = 0
+        self.readerrors = 0
+        self.readtime = 0.0
+        self.lastreadtime = 0.0
+        self.maxreadtime = 0.0
+
+    def _connect(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.nextattempt:
+                raise protocol.ConnError("owserver %s:%d: waiting %.1f S before reconnecting" %
+                                         (self.host, self.port, self.nextattempt - now))
+        try:
+            proxy = protocol.proxy(host=self.host, port=self.port, persistent=True)
+            # Enumerate the bus once. Entries look like '/28.762079A20003/'
+            devices = set([d.strip('/') for d in proxy.dir(bus=False)])
+        except Exception as e:
+            logger.error("protocol.proxy(%s,%d) failed: %s", self.host, self.port, e)
+            with self.lock:
+                self.connected = False
+                self.nextattempt = now + self.backoff
+                self.backoff = min(2 * self.backoff, self.maxbackoff)
+            raise
+        with self.lock:
+            if not self.connected:
+                logger.info("Connected to owserver %s:%d, devices: %s", self.host, self.port,
+                            devices)
+                if self.connects:
+                    self.reconnects += 1
+                self.connects += 1
+            self.connected = True
+            self.devices = devices
+            self.backoff = self.minbackoff
+            self.nextattempt = 0
+        self.local.proxy = proxy
+        self.local.generation = self.generation
+        return proxy
+
+    def _getproxy(self):
+        proxy = getattr(self.local, "proxy", None)
+        if proxy is not None and self.local.generation != self.generation:
+            self._drop()
+            proxy = None
+        if proxy is None:
+            proxy = self._connect()
+        return proxy
+
+    def _drop(self):
+        proxy = getattr(self.local, "proxy", None)
+        if proxy is not None:
+            try:
+                proxy.close_connection()
+            except Exception:
+                pass
+        self.local.proxy = None
+        self.connected = False
+
+    # Run a proxy method. A connection error causes a reconnection and a single retry: after an
+    # owserver restart, the first access on the stale socket fails but the next one succeeds.
+    def _call(self, method, *args):
+        try:
+            return getattr(self._getproxy(), method)(*args)
+        except protocol.ConnError:
+            logger.info("owserver connection lost, reconnecting")
+            self._drop()
+            return getattr(self._getproxy(), method)(*args)
+
+    def read(self, path):
+        start = time.monotonic()
+        error = False
+        try:
+            return self._call("read", path)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.reads += 1
+                if error:
+                    self.readerrors += 1
+                self.readtime += elapsed
+                self.lastreadtime = elapsed
+                if elapsed > self.maxreadtime:
+                    self.maxreadtime = elapsed
+
+    def write(self, path, data):
+        self._call("write", path, data)
+
+    # Health check: ping owserver, reconnecting if needed. Returns True if the server answers.
+    def ping(self):
+        try:
+            self._call("ping")
+            return True
+        except Exception as e:
+            logger.debug("owserver %s:%d ping failed: %s", self.host, self.port, e)
+            self._drop()
+            return False
+
+    # Force all the threads to reconnect, and allow reconnecting right away.
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.connected = False
+            self.backoff = self.minbackoff
+            self.nextattempt = 0
+        self._drop()
+
+    def stats(self):
+        with self.lock:
+            return {"connected": self.connected,
+                    "connects": self.connects,
+                    "reconnects": self.reconnects,
+                    "reads": self.reads,
+                    "readerrors": self.readerrors,
+                    "avgreadtime": self.readtime / self.reads if self.reads else 0.0,
+                    "lastreadtime": self.lastreadtime,
+                    "maxreadtime": self.maxreadtime}
+
+
+# One connection per owserver, shared by all the sensors using it.
+_connections = {}
+
+def get_connection(host=host, port=port):
+    key = (host, port)
+    if key not in _connections:
+        _connections[key] = OwConnection(host, port)
+    return _connections[key]
 
 # Utility: the ids used by the TCL code are reverted and include the
 # ck at the beginning and the family at the end. e.g:
@@ -44,27 +201,98 @@ def id_ow(inid):
         outid = inid
     return outid
 
-# Return temperature as float
-def readtemp(id):
-    sensorid = id_ow(id)
+# Read the temperature for an already converted id. latest=True reads the value latched by the
+# last conversion instead of triggering a new one.
+def _readtemp(conn, sensorid, latest=False):
+    path = '/' + sensorid + ('/latesttemp' if latest else '/temperature')
+    start = time.monotonic()
     try:
-        stemp = owproxy.read('/' + sensorid + '/temperature')
-        logger.debug("readtemp %s -> %s", sensorid, stemp)
-        return float(stemp)
+        stemp = conn.read(path)
+        logger.debug("readtemp %s -> %s", path, stemp)
+        value = float(stemp)
     except Exception as e:
+        _readerrors.inc()
         logger.exception("Could not read temperature from %s", sensorid)
         raise e
+    _readseconds.observe(time.monotonic() - start)
+    return value
+
+# Return temperature as float
+def readtemp(id):
+    return _readtemp(get_connection(), id_ow(id))
+
+# Ask all the temperature sensors on the bus to start a conversion at the same time. The
+# results can then be read from latesttemp after the conversion time (750 mS at 12 bits
+# resolution), instead of waiting a conversion time for each sensor.
+def simultaneous_temperature(conn):
+    conn.write('/simultaneous/temperature', b'1')
 
+
+# A temperature value computed as the average of one or several sensors. When there are several
+# sensors, we use a single simultaneous conversion for all of them, then read the values in
+# parallel. Sensors which fail to read are left out of the average (see the quality member for
+# the state of each), and we only fail if no sensor could be read.
 class Temp(object):
     def __init__(self, config, myconfig):
         self.ids = myconfig["ids"]
+        # Do the id conversions once
+        self.owids = [id_ow(id) for id in self.ids]
+        self.conn = get_connection(myconfig.get("host", host), int(myconfig.get("port", port)))
+        self.simultaneous = myconfig.get("simultaneous", len(self.owids) > 1)
+        self.conversiontime = float(myconfig.get("conversiontime", 0.75))
+        self.executor = None
+        if len(self.owids) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=min(len(self.owids), 8))
+        # Per-sensor result of the last read: owid -> {"value", "ok", "error", "time"}
+        self.quality = {}
+        # Try connecting right away for the log messages, but failing is not fatal here, we'll
+        # retry when reading.
+        if self.conn.ping():
+            for owid in self.owids:
+                if owid not in self.conn.devices:
+                    logger.error("Sensor %s not found on the bus", owid)
+
+    def _readone(self, owid, latest):
+        try:
+            value = _readtemp(self.conn, owid, latest)
+            result = {"value": value, "ok": True, "error": None}
+        except Exception as e:
+            result = {"value": None, "ok": False, "error": str(e)}
+        result["time"] = time.time()
+        return owid, result
+
+    def readall(self):
+        latest = False
+        if self.simultaneous:
+            try:
+                simultaneous_temperature(self.conn)
+                time.sleep(self.conversiontime)
+                latest = True
+            except Exception as e:
+                logger.error("Simultaneous conversion failed, reading sensors one by one: %s", e)
+        if self.executor:
+            results = self.executor.map(lambda owid: self._readone(owid, latest), self.owids)
+        else:
+            results = [self._readone(owid, latest) for owid in self.owids]
+        self.quality = dict(results)
+        return self.quality
 
     def current(self):
-        temp = 0.0
-        for id in self.ids:
-            temp += readtemp(id)
-        temp = temp / len(g_housetempids)
-        return temp
+        values = [r["value"] for r in self.readall().values() if r["ok"]]
+        if not values:
+            raise Exception("owif.Temp: could not read any of %s" % self.owids)
+        if len(values) != len(self.owids):
+            logger.warning("owif.Temp: only %d of %d sensors read", len(values), len(self.owids))
+        return sum(values) / len(values)
+
+    def stats(self):
+        return self.conn.stats()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.conn.reset()
     
 
 ##########
@@ -75,6 +303,7 @@ if __name__ == '__main__':
         perr("Usage: owif.py <id> <cmd>")
         perr("cmd:")
         perr("  readtemp")
+        perr("  stats")
         sys.exit(1)
     if len(sys.argv) <= 2:
         usage()
@@ -84,6 +313,8 @@ if __name__ == '__main__':
         perr("cmd %s" % cmd)
         if cmd == "readtemp":
             print("Temp: %.2f" % readtemp(id))
+        elif cmd == "stats":
+            print("%s" % get_connection().stats())
         else:
             usage()
     
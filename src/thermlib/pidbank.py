@@ -0,0 +1,142 @@
+# A bank of PID controllers stored in columns, for stepping many heating zones at once.
+#
+# Controller k is described by the k-th element of each column (gains, setpoint, limits, integral,
+# last input...). step() updates all the controllers in a single pass over the columns, without
+# any per-controller object, property access or log call, and writes the commands to the outputs
+# column. The columns are preallocated lists: array.array would be more compact, but each element
+# access creates a new float object, which makes the step about twice slower.
+#
+# The computation is the same as PID.PID.__call__ (proportional on error or on measurement,
+# sample_time None), in the same order, so that the results are identical to the last bit.
+#
+# Differences with PID.PID: the bank has a single clock (all controllers are stepped together), and
+# missing values are NaN instead of None (outputs of controllers never computed).
+
+import math
+import logging
+
+from thermlib import PID
+
+logger = logging.getLogger(__name__)
+
+_nan = float("nan")
+_inf = float("inf")
+
+def _limit(value, default):
+    return default if value is None else float(value)
+
+
+class PIDBank(object):
+    __slots__ = ("size", "Kp", "Ki", "Kd", "setpoint", "minout", "maxout", "pom", "auto",
+                 "proportional", "integral", "derivative", "lastinput", "hasinput", "outputs",
+                 "lasttime")
+
+    def __init__(self, size, Kp=1.0, Ki=0.0, Kd=0.0, setpoint=0, output_limits=(None, None),
+                 proportional_on_measurement=False):
+        self.size = size
+        self.Kp = [Kp] * size
+        self.Ki = [Ki] * size
+        self.Kd = [Kd] * size
+        self.setpoint = [setpoint] * size
+        # Missing limits are stored as infinities, which compare the same way as no limit
+        self.minout = [_limit(output_limits[0], -_inf)] * size
+        self.maxout = [_limit(output_limits[1], _inf)] * size
+        self.pom = [1 if proportional_on_measurement else 0] * size
+        self.auto = [1] * size
+        self.proportional = [0.0] * size
+        self.integral = [0.0] * size
+        self.derivative = [0.0] * size
+        self.lastinput = [0.0] * size
+        self.hasinput = [0] * size
+        self.outputs = [_nan] * size
+        self.lasttime = PID._current_time()
+
+    def set_tunings(self, k, Kp, Ki, Kd):
+        self.Kp[k] = Kp
+        self.Ki[k] = Ki
+        self.Kd[k] = Kd
+
+    def set_setpoint(self, k, setpoint):
+        self.setpoint[k] = setpoint
+
+    def set_output_limits(self, k, limits):
+        lower, upper = limits
+        if lower is not None and upper is not None and upper < lower:
+            raise ValueError('lower limit must be less than upper limit')
+        self.minout[k] = _limit(lower, -_inf)
+        self.maxout[k] = _limit(upper, _inf)
+        self.integral[k] = self._clamp(k, self.integral[k])
+        if not math.isnan(self.outputs[k]):
+            self.outputs[k] = self._clamp(k, self.outputs[k])
+
+    def _clamp(self, k, value):
+        if value > self.maxout[k]:
+            return self.maxout[k]
+        elif value < self.minout[k]:
+            return self.minout[k]
+        return value
+
+    def reset(self, k):
+        self.proportional[k] = 0.0
+        self.integral[k] = 0.0
+        self.derivative[k] = 0.0
+        self.hasinput[k] = 0
+        self.outputs[k] = _nan
+
+    # Same as PID.set_auto_mode(): going back to auto resets the controller, starting from
+    # last_output as integral (bumpless transfer).
+    def set_auto_mode(self, k, enabled, last_output=None):
+        if enabled and not self.auto[k]:
+            self.reset(k)
+            self.integral[k] = self._clamp(k, 0.0 if last_output is None else last_output)
+        self.auto[k] = 1 if enabled else 0
+
+    def components(self, k):
+        return self.proportional[k], self.integral[k], self.derivative[k]
+
+    # Compute new outputs for all the controllers. inputs is a sequence of size values. dt is the
+    # time step, computed from the clock if not set. Returns the outputs list (updated in place).
+    def step(self, inputs, dt=None):
+        now = PID._current_time()
+        if dt is None:
+            dt = now - self.lasttime if now - self.lasttime else 1e-16
+        elif dt <= 0:
+            raise ValueError("dt has nonpositive value {}. Must be positive.".format(dt))
+        Kp, Ki, Kd = self.Kp, self.Ki, self.Kd
+        setpoint, minout, maxout = self.setpoint, self.minout, self.maxout
+        pom, auto, hasinput = self.pom, self.auto, self.hasinput
+        prop, integ, deriv = self.proportional, self.integral, self.derivative
+        lastinput, outputs = self.lastinput, self.outputs
+        for k in range(self.size):
+            if not auto[k]:
+                continue
+            input_ = inputs[k]
+            error = setpoint[k] - input_
+            d_input = input_ - (lastinput[k] if hasinput[k] else input_)
+            if not pom[k]:
+                p = Kp[k] * error
+            else:
+                p = prop[k] - Kp[k] * d_input
+            prop[k] = p
+            lo = minout[k]
+            hi = maxout[k]
+            i = integ[k] + Ki[k] * error * dt
+            if i > hi:
+                i = hi
+            elif i < lo:
+                i = lo
+            integ[k] = i
+            d = -Kd[k] * d_input / dt
+            deriv[k] = d
+            output = p + i + d
+            if output > hi:
+                output = hi
+            elif output < lo:
+                output = lo
+            outputs[k] = output
+            lastinput[k] = input_
+            hasinput[k] = 1
+        self.lasttime = now
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("PIDBank: dt %.2f stepped %d controllers", dt, self.size)
+        return outputs
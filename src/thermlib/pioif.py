@@ -21,7 +21,10 @@ logger = logging.getLogger(__name__)
 # The python "platform" module is not really helpful to determine the
 # machine type. Rely on /boot files instead.
 machine = "unknown"
-_bootfiles = os.listdir("/boot")
+try:
+    _bootfiles = os.listdir("/boot")
+except OSError:
+    _bootfiles = []
 for f in _bootfiles:
     if fnmatch.fnmatch(f, "*meson64*"):
         machine = "odroid"
@@ -38,8 +41,10 @@ try:
     else:
         raise Exception("Unknown machine %s" %machine)
 except Exception as err:
-    logger.critical("Error importing GPIO module for %s: %s" % (machine, err))
-    sys.exit(1)
+    # Don't exit here: the importer decides what to do (we are only imported when a gpio
+    # switch is configured).
+    logger.critical("Error importing GPIO module for %s: %s", machine, err)
+    raise ImportError("pioif: no GPIO module for machine %s: %s" % (machine, err))
 
 class PioIf(object):
     # We do things in several executions. A channel already setup is normal
@@ -0,0 +1,185 @@
+# Time-proportioning (slow PWM) control of several heater relays sharing a supply.
+#
+# Each zone gets a command (0-100, typically from its PID) which is converted to an on time within
+# the common heating period, with the same minimum on/off rules as the single zone thermostat (see
+# heatseconds()). If all the zones started heating at the beginning of the period, the relays
+# would all close together. Instead, the on windows are placed one after the other around the
+# period, zone k starting where zone k-1 ends (modulo the period). The number of relays on at the
+# same time is then never more than ceil(sum of on times / period), which is the minimum.
+#
+# The offset of a zone is the sum of the on times of the zones before it. The on times are kept in
+# a Fenwick tree, so that changing one zone's command and computing an offset are O(log n). A zone
+# picks up its new offset at the start of its next period, and its relay is never switched back on
+# less than the minimum off time after it was switched off.
+#
+# The timers are managed by a scheduler.ActuationScheduler.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Convert a command (0-100) to heating seconds in the period. Short on or off times are avoided:
+# an on time shorter than 1/20 of the period or than minseconds becomes 0, and one which would
+# leave a shorter off time becomes period + 10 (always on).
+def heatseconds(period, command, minseconds):
+    seconds = (period * command) / 100.0
+    if seconds < (period / 20) or seconds < minseconds:
+        seconds = 0
+    if seconds > 0.95 * period or seconds > period - minseconds:
+        seconds = period + 10
+    return seconds
+
+
+# Binary indexed tree of floats, for prefix sums with O(log n) updates
+class _Fenwick(object):
+    def __init__(self, values):
+        self.size = len(values)
+        self.tree = [0.0] * (self.size + 1)
+        for i, value in enumerate(values):
+            self.add(i, value)
+
+    def add(self, i, delta):
+        i += 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    # Sum of the values before index i
+    def prefix(self, i):
+        total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+class _Zone(object):
+    def __init__(self, name, index, switch):
+        self.name = name
+        self.index = index
+        self.switch = switch
+        self.command = 0
+        self.heatseconds = 0
+        # Weight in the offsets tree (on time, at most the period)
+        self.weight = 0.0
+        # Scheduled time of the last turn off, and of the current on window
+        self.lastoff = None
+        self.onstart = None
+
+
+class StaggeredPWM(object):
+    def __init__(self, timers, period, minseconds=60):
+        self.timers = timers
+        self.period = float(period)
+        self.minseconds = minseconds
+        # Minimum off time between two on windows, same as the heatseconds() rules
+        self.minoff = max(self.period / 20, minseconds)
+        self.zones = {}
+        self.weights = []
+        self.tree = _Fenwick([0.0] * 16)
+        self.start = None
+        # Statistics
+        self.updates = 0
+        self.delayed = 0
+
+    def addzone(self, name, switch, command=0):
+        if name in self.zones:
+            raise Exception("StaggeredPWM: zone %s exists" % name)
+        zone = _Zone(name, len(self.weights), switch)
+        self.zones[name] = zone
+        self.weights.append(0.0)
+        if len(self.weights) > self.tree.size:
+            self.tree = _Fenwick(self.weights + [0.0] * len(self.weights))
+        self.setcommand(name, command)
+        if self.start is not None:
+            self._startzone(zone)
+        return zone
+
+    def removezone(self, name):
+        zone = self.zones.pop(name)
+        self._setweight(zone, 0.0)
+        self.timers.cancel(("cycle", name))
+        self.timers.cancel(("relay", name))
+        zone.switch.turnoff()
+
+    def _setweight(self, zone, weight):
+        if weight != zone.weight:
+            self.tree.add(zone.index, weight - zone.weight)
+            self.weights[zone.index] = weight
+            zone.weight = weight
+
+    # Change the command for a zone. This takes effect at the start of its next period.
+    def setcommand(self, name, command):
+        zone = self.zones[name]
+        zone.command = command
+        zone.heatseconds = heatseconds(self.period, command, self.minseconds)
+        self._setweight(zone, min(zone.heatseconds, self.period))
+        self.updates += 1
+
+    # Phase of the zone's on window in the period
+    def offset(self, name):
+        return self.tree.prefix(self.zones[name].index) % self.period
+
+    # Start cycling all the zones, on a common period grid beginning at start (scheduler clock)
+    def run(self, start=None):
+        self.start = self.timers.time() if start is None else start
+        for zone in self.zones.values():
+            self._startzone(zone)
+
+    def _startzone(self, zone):
+        # First period boundary on the common grid, from now
+        now = self.timers.time()
+        if now <= self.start:
+            first = self.start
+        else:
+            first = self.start + self.period * (int((now - self.start) // self.period) + 1)
+            # Start now anyway, with the offset computed from the current period.
+            self._cycle(zone, first - self.period)
+        self.timers.periodic(("cycle", zone.name), self.period, self._cycle, zone, start=first)
+
+    def _cycle(self, zone, cyclestart=None):
+        if cyclestart is None:
+            cyclestart = self.timers.firing if self.timers.firing is not None else \
+                self.timers.time()
+        seconds = zone.heatseconds
+        key = ("relay", zone.name)
+        if seconds <= 0:
+            # Let a window started in the previous period finish, but end an always on state
+            if zone.lastoff is None and zone.onstart is not None:
+                zone.switch.turnoff()
+                zone.lastoff = cyclestart
+            return
+        if seconds >= self.period:
+            self.timers.cancel(key)
+            zone.switch.turnon()
+            # Always on: no scheduled turn off
+            zone.lastoff = None
+            zone.onstart = cyclestart
+            return
+        if zone.lastoff is None and zone.onstart is not None:
+            # Was always on: end it now, the new window starts after the minimum off time
+            zone.switch.turnoff()
+            zone.lastoff = cyclestart
+        onstart = cyclestart + self.offset(zone.name)
+        if zone.lastoff is not None and onstart < zone.lastoff + self.minoff:
+            self.delayed += 1
+            onstart = zone.lastoff + self.minoff
+        zone.onstart = onstart
+        zone.lastoff = onstart + seconds
+        logger.debug("StaggeredPWM: %s on at +%.0f for %.0f S", zone.name,
+                     onstart - cyclestart, seconds)
+        self.timers.at(key, onstart, zone.switch.turnon)
+        self.timers.at(key, onstart + seconds, zone.switch.turnoff)
+
+    def stop(self):
+        for zone in self.zones.values():
+            self.timers.cancel(("cycle", zone.name))
+            self.timers.cancel(("relay", zone.name))
+        self.start = None
+
+    def stats(self):
+        total = sum(self.weights)
+        return {"zones": len(self.zones), "updates": self.updates, "delayed": self.delayed,
+                "load": total / self.period,
+                "minpeak": int(-(-total // self.period))}
@@ -0,0 +1,82 @@
+# Adaptive sensor sampling: decide when to read a sensor next, depending on how close the value is
+# to a switching threshold and how fast it is changing.
+#
+# - Far from any threshold and stable: sample every maxinterval seconds.
+# - Within neardistance of a threshold: the interval shrinks linearly with the distance, down to
+#   mininterval.
+# - If the value is moving, we also make sure to sample again before it could reach the nearest
+#   threshold at the current rate (sampling twice in that time).
+# - An optional budget limits the number of samples per hour for the sensor (token bucket), for
+#   battery devices or slow buses. The budget wins over the other rules, but never makes the
+#   interval longer than maxinterval.
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveSampler(object):
+    def __init__(self, mininterval=60, maxinterval=600, neardistance=0.5, budgetperhour=0,
+                 clock=time.monotonic):
+        self.mininterval = float(mininterval)
+        self.maxinterval = float(maxinterval)
+        self.neardistance = float(neardistance)
+        self.budgetperhour = float(budgetperhour)
+        self.clock = clock
+        self.lastvalue = None
+        self.lasttime = None
+        # Rate of change in units per second, from the last two samples
+        self.rate = 0.0
+        self.tokens = self.budgetperhour
+        self.tokentime = clock()
+        # Statistics
+        self.samples = 0
+
+    def _takebudget(self, now):
+        if not self.budgetperhour:
+            return 0.0
+        self.tokens = min(self.budgetperhour,
+                          self.tokens + (now - self.tokentime) * self.budgetperhour / 3600.0)
+        self.tokentime = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        # Time until the bucket is back to zero
+        return -self.tokens * 3600.0 / self.budgetperhour
+
+    # Record a new sample and return the number of seconds to wait before the next one.
+    # thresholds is the list of values where the controller would switch.
+    def next_interval(self, value, thresholds):
+        now = self.clock()
+        self.samples += 1
+        if self.lasttime is not None and now > self.lasttime:
+            self.rate = (value - self.lastvalue) / (now - self.lasttime)
+        self.lastvalue = value
+        self.lasttime = now
+
+        interval = self.maxinterval
+        if thresholds:
+            distance = min([abs(value - t) for t in thresholds])
+            if self.neardistance > 0 and distance < self.neardistance:
+                interval = self.mininterval + \
+                    (self.maxinterval - self.mininterval) * distance / self.neardistance
+            # Moving towards a threshold ?
+            approaching = [abs(value - t) for t in thresholds if (t - value) * self.rate > 0]
+            if approaching:
+                interval = min(interval, min(approaching) / abs(self.rate) / 2.0)
+        interval = max(self.mininterval, min(self.maxinterval, interval))
+        wait = self._takebudget(now)
+        interval = min(self.maxinterval, max(interval, wait))
+        logger.debug("AdaptiveSampler: value %.2f rate %.5f/S thresholds %s -> %.0f S", value,
+                     self.rate, thresholds, interval)
+        return interval
+
+
+# Build a sampler from configuration values, using the given defaults for the missing ones.
+# conf has a get() method (utils.Config or conftree.ConfSimple)
+def make_sampler(conf, mininterval, maxinterval, neardistance):
+    return AdaptiveSampler(float(conf.get("minsampleseconds") or mininterval),
+                           float(conf.get("maxsampleseconds") or maxinterval),
+                           float(conf.get("samplenear") or neardistance),
+                           float(conf.get("samplebudgetperhour") or 0))
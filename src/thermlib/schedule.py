@@ -0,0 +1,228 @@
+# Setpoint schedules: day programs, a week of day programs, and holiday overrides.
+#
+# The schedule is compiled into a sorted timeline of (time, setpoint) transitions covering the
+# next "horizon" days. Finding the current setpoint is a bisection, and get() only does a time
+# comparison until the next transition. The timeline is recompiled when we get near its end.
+#
+# Configuration (the "schedule" section of the thermostat configuration):
+#   "default": setpoint used before the first transition
+#   "days": named day programs, lists of ["HH:MM", setpoint]
+#   "week": the day program names for monday to sunday
+#   "holidays": list of overrides, applied in order (the last matching one wins), with "from"
+#       and "to" dates (YYYY-MM-DD, inclusive), and either a "setpoint" for the whole days, or a
+#       "day" program name
+#   "horizon": number of days compiled ahead, default 7
+#   "preheat": if true, raising the setpoint starts earlier, by the time needed to heat at the
+#       heating rate, computed from the state logs in "heatinglog" (default: the git data repo),
+#       or "heatingrate" degrees per hour if there is no usable data. The lead time is at most
+#       "maxpreheat" seconds (default 7200).
+
+import os
+import json
+import time
+import bisect
+import logging
+import datetime
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _parsetime(hhmm):
+    h, m = hhmm.split(":")
+    h = int(h)
+    m = int(m)
+    if not 0 <= h <= 24 or not 0 <= m < 60:
+        raise Exception("schedule: bad time %s" % hhmm)
+    return h, m
+
+def _parsedate(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d").date()
+
+
+# Compute the heating rate in degrees per hour from the StateLogger files in datarepo
+# (YYYY-MM-DD-templog, one [time, {"temp", "on", ...}] JSON array per line) for the last days:
+# the temperature gained while the heater was on, divided by the time it was on. Returns None
+# if there is not enough data.
+def heatingrate(datarepo, days=7, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    gained = 0.0
+    ontime = 0.0
+    for n in range(days, -1, -1):
+        day = (now - datetime.timedelta(days=n)).strftime("%Y-%m-%d")
+        fn = os.path.join(datarepo, day + "-templog")
+        try:
+            with open(fn, "r") as f:
+                lines = f.readlines()
+        except Exception:
+            continue
+        previous = None
+        for line in lines:
+            try:
+                tm, values = json.loads(line)
+                tm = time.mktime(time.strptime(tm, "%Y-%m-%d/%H:%M:%S"))
+                record = (tm, float(values["temp"]), int(values.get("on", 0)))
+            except Exception:
+                continue
+            # Only use the intervals with the heater on, and not too long (missing data)
+            if previous and previous[2] and 0 < record[0] - previous[0] < 3600:
+                gained += record[1] - previous[1]
+                ontime += record[0] - previous[0]
+            previous = record
+    if ontime < 3600 or gained <= 0:
+        return None
+    return 3600.0 * gained / ontime
+
+
+class Schedule(object):
+    def __init__(self, config, datarepo=None):
+        self.default = float(config.get("default", 16.0))
+        self.days = {}
+        for name, program in config.get("days", {}).items():
+            entries = sorted([(_parsetime(t), float(v)) for t, v in program])
+            self.days[name] = entries
+        self.week = config.get("week", [])
+        if len(self.week) != 7:
+            raise Exception("schedule: week must list 7 day programs")
+        for name in self.week:
+            if name not in self.days:
+                raise Exception("schedule: unknown day program %s" % name)
+        self.holidays = []
+        for holiday in config.get("holidays", []):
+            day = holiday.get("day")
+            if day is not None and day not in self.days:
+                raise Exception("schedule: unknown day program %s" % day)
+            if day is None and holiday.get("setpoint") is None:
+                raise Exception("schedule: holiday needs a day or a setpoint")
+            self.holidays.append((_parsedate(holiday["from"]), _parsedate(holiday["to"]), day,
+                                  holiday.get("setpoint")))
+        self.horizon = int(config.get("horizon", 7))
+        self.preheat = config.get("preheat", False)
+        self.maxpreheat = float(config.get("maxpreheat", 7200))
+        self.defaultrate = float(config.get("heatingrate", 1.0))
+        self.heatinglog = config.get("heatinglog", datarepo)
+        self.rate = None
+        self.times = []
+        self.values = []
+        self.end = 0
+        self.compile()
+
+    # Day program or fixed setpoint for a date
+    def _program(self, date):
+        for start, end, day, setpoint in reversed(self.holidays):
+            if start <= date <= end:
+                if day is not None:
+                    return self.days[day]
+                return [((0, 0), float(setpoint))]
+        return self.days[self.week[date.weekday()]]
+
+    # Build the timeline from yesterday (so that we know the current value) to the horizon.
+    def compile(self, now=None):
+        if now is None:
+            now = time.time()
+        today = datetime.date.fromtimestamp(now)
+        transitions = []
+        for n in range(-1, self.horizon + 1):
+            date = today + datetime.timedelta(days=n)
+            for (h, m), value in self._program(date):
+                dt = datetime.datetime.combine(date, datetime.time(0, 0)) + \
+                    datetime.timedelta(hours=h, minutes=m)
+                transitions.append((time.mktime(dt.timetuple()), value))
+        transitions.sort()
+        if self.preheat:
+            transitions = self._preheat(transitions)
+        times = []
+        values = []
+        for tm, value in transitions:
+            if values and value == values[-1]:
+                continue
+            times.append(tm)
+            values.append(value)
+        self.times = times
+        self.values = values
+        end = datetime.datetime.combine(today + datetime.timedelta(days=self.horizon + 1),
+                                        datetime.time(0, 0))
+        self.end = time.mktime(end.timetuple())
+        logger.debug("schedule: compiled %d transitions", len(times))
+
+    # Move the transitions which raise the setpoint earlier, by the time needed to heat. A
+    # transition is never moved before the previous one.
+    def _preheat(self, transitions):
+        rate = None
+        if self.heatinglog:
+            rate = heatingrate(self.heatinglog)
+        self.rate = rate or self.defaultrate
+        logger.info("schedule: preheating with a heating rate of %.2f degrees/hour", self.rate)
+        result = []
+        previous = self.default
+        for tm, value in transitions:
+            if value > previous:
+                lead = min(self.maxpreheat, 3600.0 * (value - previous) / self.rate)
+                tm -= lead
+                if result and tm <= result[-1][0]:
+                    tm = result[-1][0] + 1
+            result.append((tm, value))
+            previous = value
+        return result
+
+    # Return (setpoint, time of the next change)
+    def lookup(self, now):
+        if now >= self.end - 86400:
+            self.compile(now)
+        i = bisect.bisect_right(self.times, now) - 1
+        value = self.values[i] if i >= 0 else self.default
+        nextchange = self.times[i + 1] if i + 1 < len(self.times) else self.end - 86400
+        return value, nextchange
+
+
+# Setpoint getter following a schedule. get() returns the cached value until the next change. If
+# subscribers are registered, a timer calls them at each change.
+class ScheduleGetter(object):
+    def __init__(self, config, datarepo=None):
+        self.schedule = Schedule(config, datarepo)
+        self.current = None
+        self.nextchange = 0
+        self.callbacks = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def _update(self, now):
+        with self.lock:
+            if now >= self.nextchange:
+                self.current, self.nextchange = self.schedule.lookup(now)
+                logger.debug("schedule: setpoint %.1f until %s", self.current,
+                             time.ctime(self.nextchange))
+            return self.current
+
+    def get(self):
+        now = time.time()
+        if now < self.nextchange:
+            return self.current
+        return self._update(now)
+
+    def _arm(self):
+        # The timer is wall clock based: limit the wait so that clock changes are noticed.
+        delay = min(3600, max(1, self.nextchange - time.time()))
+        self.timer = threading.Timer(delay, self._fire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _fire(self):
+        previous = self.current
+        if self._update(time.time()) != previous:
+            for callback in self.callbacks:
+                callback()
+        self._arm()
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+        if self.timer is None:
+            self.get()
+            self._arm()
+        return True
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,160 @@
+# Timer scheduler for the actuators (relays on/off, heating periods), on top of an asyncio loop.
+#
+# - Deadlines are in the loop clock (monotonic), so wall clock jumps (NTP, DST) change nothing.
+# - All the events are kept in a heap, with a single loop timer armed for the earliest one. This
+#   stays cheap with hundreds of relays.
+# - Events are grouped by key (e.g. a relay name). cancel(key) bumps the key generation: the
+#   pending events for the key are then ignored when they come up, without searching the heap.
+#   A callback can never fire for a previous generation, even if the cancellation happens while
+#   the loop is already processing due events.
+# - Periodic events are aligned on their first deadline (start + n * period) instead of being
+#   re-scheduled from the time the callback ran, so the periods do not drift. If the loop was
+#   blocked for more than a period, the missed occurrences are skipped, not run in a burst.
+# - The lateness of each event (time of the callback - deadline) is recorded, see stats().
+
+import heapq
+import logging
+import asyncio
+import collections
+
+logger = logging.getLogger(__name__)
+
+# Events due within this time are run at once, the loop timers may fire a bit early.
+_tolerance = 0.001
+
+
+class ActuationScheduler(object):
+    def __init__(self, loop=None, jitterwindow=1000):
+        # The loop is bound on first use if not set
+        self.loop = loop
+        self.heap = []
+        self.generations = {}
+        self.seq = 0
+        self.timer = None
+        self.timerdeadline = None
+        # Deadline of the event whose callback is running, None outside of callbacks
+        self.firing = None
+        # Statistics
+        self.jitter = collections.deque(maxlen=jitterwindow)
+        self.fired = 0
+        self.skipped = 0
+        self.maxjitter = 0.0
+
+    def _getloop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop
+
+    # Current time in the scheduler clock
+    def time(self):
+        return self._getloop().time()
+
+    def _push(self, deadline, key, generation, period, callback, args):
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, key, generation, period, callback, args))
+
+    # Schedule callback(*args) at the given deadline (scheduler clock). Returns the generation
+    # of the key, which is current until cancel(key) is called.
+    def at(self, key, deadline, callback, *args):
+        generation = self.generations.setdefault(key, 0)
+        self._push(deadline, key, generation, None, callback, args)
+        self._arm()
+        return generation
+
+    def later(self, key, delay, callback, *args):
+        return self.at(key, self.time() + delay, callback, *args)
+
+    # Call callback(*args) every period seconds, starting at start (default: now).
+    def periodic(self, key, period, callback, *args, start=None):
+        if period <= 0:
+            raise ValueError("ActuationScheduler: period must be positive")
+        if start is None:
+            start = self.time()
+        generation = self.generations.setdefault(key, 0)
+        self._push(start, key, generation, period, callback, args)
+        self._arm()
+        return generation
+
+    # Drop all the pending events for key
+    def cancel(self, key):
+        self.generations[key] = self.generations.get(key, 0) + 1
+
+    def generation(self, key):
+        return self.generations.get(key, 0)
+
+    # Number of live pending events, for key or for all keys
+    def pending(self, key=None):
+        return len([e for e in self.heap if (key is None or e[2] == key) and
+                    e[3] == self.generations.get(e[2], 0)])
+
+    def _arm(self):
+        # Get rid of the cancelled events at the top of the heap
+        heap = self.heap
+        while heap and heap[0][3] != self.generations.get(heap[0][2], 0):
+            heapq.heappop(heap)
+        if not heap:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+                self.timerdeadline = None
+            return
+        deadline = heap[0][0]
+        if self.timer and self.timerdeadline <= deadline:
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.timerdeadline = deadline
+        self.timer = self._getloop().call_at(deadline, self._run)
+
+    def _run(self):
+        self.timer = None
+        self.timerdeadline = None
+        heap = self.heap
+        skipped = 0
+        while heap:
+            now = self.time()
+            deadline, seq, key, generation, period, callback, args = heap[0]
+            if deadline > now + _tolerance:
+                break
+            heapq.heappop(heap)
+            if generation != self.generations.get(key, 0):
+                continue
+            lateness = now - deadline
+            self.jitter.append(lateness)
+            self.fired += 1
+            if lateness > self.maxjitter:
+                self.maxjitter = lateness
+            if period is not None:
+                # Next aligned occurrence, skipping the missed ones
+                nextdeadline = deadline + period
+                if nextdeadline <= now:
+                    missed = int((now - deadline) // period)
+                    skipped += missed
+                    nextdeadline = deadline + (missed + 1) * period
+                self._push(nextdeadline, key, generation, period, callback, args)
+            self.firing = deadline
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception("ActuationScheduler: %s: callback failed: %s", key, e)
+            self.firing = None
+        if skipped:
+            self.skipped += skipped
+            logger.warning("ActuationScheduler: loop was late, skipped %d periodic events",
+                           skipped)
+        self._arm()
+
+    def stats(self):
+        jitter = sorted(self.jitter)
+        n = len(jitter)
+        return {"fired": self.fired, "skipped": self.skipped, "pending": self.pending(),
+                "jittermean": sum(jitter) / n if n else 0.0,
+                "jitterp99": jitter[min(n - 1, int(0.99 * n))] if n else 0.0,
+                "jittermax": self.maxjitter}
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+            self.timerdeadline = None
+        self.heap = []
@@ -0,0 +1,218 @@
+# Sensor value cache, to be used when several consumers (threads in one process, or several
+# daemons on the same host) read the same sensors.
+#
+# - Each value is kept for a per-sensor time to live (ttl).
+# - Concurrent callers asking for the same sensor while a read is in progress wait for this read
+#   and share its result instead of starting their own.
+# - Optionally, values are also shared between processes through small files in a directory
+#   which should be on a tmpfs (e.g. /dev/shm/thermcache or /run/thermcache). A lock file per
+#   sensor ensures that only one process does the physical read, the others then find the fresh
+#   value in the file.
+#
+# Read errors are never cached: the next caller will try again.
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Inflight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.time = None
+        self.error = None
+
+
+class SensorCache(object):
+    def __init__(self, shareddir=None):
+        self.shareddir = shareddir
+        if shareddir:
+            os.makedirs(shareddir, exist_ok=True)
+        self.lock = threading.Lock()
+        # key -> (value, time.time())
+        self.entries = {}
+        # key -> _Inflight for the reads in progress
+        self.inflight = {}
+        # Statistics
+        self.hits = 0
+        self.sharedhits = 0
+        self.coalesced = 0
+        self.reads = 0
+        self.errors = 0
+
+    def get(self, key, readfunc, ttl):
+        return self.getsample(key, readfunc, ttl)[0]
+
+    # Same as get(), returning (value, time of the physical read)
+    def getsample(self, key, readfunc, ttl):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[1] < ttl:
+                self.hits += 1
+                return entry
+            inflight = self.inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = _Inflight()
+                self.inflight[key] = inflight
+            else:
+                self.coalesced += 1
+        if not owner:
+            inflight.event.wait()
+            if inflight.error:
+                raise inflight.error
+            return inflight.value, inflight.time
+
+        try:
+            if self.shareddir:
+                value, tm = self._sharedread(key, readfunc, ttl)
+            else:
+                value, tm = self._read(readfunc)
+            inflight.value = value
+            inflight.time = tm
+            with self.lock:
+                self.entries[key] = (value, tm)
+            return value, tm
+        except Exception as e:
+            inflight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            inflight.event.set()
+
+    def _read(self, readfunc):
+        try:
+            value = readfunc()
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.reads += 1
+        return value, time.time()
+
+    def _sharedread(self, key, readfunc, ttl):
+        fn = os.path.join(self.shareddir, key)
+        with open(fn + ".lock", "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(fn, "r") as f:
+                        data = json.load(f)
+                    if time.time() - data["time"] < ttl:
+                        with self.lock:
+                            self.sharedhits += 1
+                        return data["value"], data["time"]
+                except (OSError, ValueError, KeyError):
+                    pass
+                value, tm = self._read(readfunc)
+                tmpfn = "%s.%d.tmp" % (fn, os.getpid())
+                try:
+                    with open(tmpfn, "w") as f:
+                        json.dump({"value": value, "time": tm}, f)
+                    os.replace(tmpfn, fn)
+                except Exception as e:
+                    logger.error("Could not write shared cache file %s: %s", fn, e)
+                return value, tm
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    # Forget the value for key (all the in-process values if key is None). The shared file for key
+    # is removed too, so that neither we nor the other processes get the obsolete value.
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+        if key is not None and self.shareddir:
+            fn = os.path.join(self.shareddir, key)
+            try:
+                with open(fn + ".lock", "w") as lockf:
+                    fcntl.flock(lockf, fcntl.LOCK_EX)
+                    try:
+                        os.remove(fn)
+                    except FileNotFoundError:
+                        pass
+                    finally:
+                        fcntl.flock(lockf, fcntl.LOCK_UN)
+            except OSError as e:
+                logger.error("Could not remove shared cache file %s: %s", fn, e)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "sharedhits": self.sharedhits,
+                    "coalesced": self.coalesced, "reads": self.reads, "errors": self.errors}
+
+
+# One cache per shared directory (None for the process-only one).
+_caches = {}
+_cacheslock = threading.Lock()
+
+def get_cache(shareddir=None):
+    with _cacheslock:
+        if shareddir not in _caches:
+            _caches[shareddir] = SensorCache(shareddir)
+        return _caches[shareddir]
+
+# Configuration values identifying the device read by a sensor, for the backends with no "ids"
+# (e.g. zwavejs2mqtt)
+_idkeys = ("nodeid", "endpoint", "property_current")
+
+# Compute a cache key from a sensor configuration, which is the same for identical sensors
+# configured in different daemons. Only the backend type and the sensor ids are used: the other
+# values (filters, owserver address, options...) may differ between daemons reading the same
+# sensor. The result is usable as a file name.
+def make_key(myconfig):
+    if "cachekey" in myconfig:
+        return myconfig["cachekey"]
+    parts = [str(myconfig.get("type"))]
+    ids = myconfig.get("ids")
+    if ids:
+        parts += sorted([str(id) for id in ids])
+    parts += ["%s" % myconfig[k] for k in _idkeys if k in myconfig]
+    key = "-".join(parts)
+    return "".join([c if c.isalnum() or c in "._-" else "_" for c in key])
+
+
+# Wraps a sensor object (anything with a current() method), returning cached values. Other
+# attributes are forwarded to the sensor.
+class CachedSensor(object):
+    def __init__(self, sensor, key, ttl, cache=None):
+        self.sensor = sensor
+        self.key = key
+        self.ttl = ttl
+        self.cache = cache if cache else get_cache()
+        # Time of the physical read of the last value returned
+        self.sampletime = None
+
+    def current(self):
+        value, self.sampletime = self.cache.getsample(self.key, self.sensor.current, self.ttl)
+        return value
+
+    # Pushed updates make our cached value obsolete
+    def subscribe(self, callback):
+        subscribe = getattr(self.sensor, "subscribe", None)
+        if subscribe is None:
+            return False
+        def onupdate(*args):
+            self.cache.invalidate(self.key)
+            callback(*args)
+        return subscribe(onupdate)
+
+    def close(self):
+        self.cache.invalidate(self.key)
+        close = getattr(self.sensor, "close", None)
+        if close:
+            close()
+
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
@@ -1,43 +1,134 @@
 #!/usr/bin/python3
 
-import json
 import sys
+import time
+import logging
+import importlib
+
+logger = logging.getLogger(__name__)
+
+# Registry of the device backends: (kind, type) -> "module:attribute" for the class to
+# instantiate, or the class itself. kind is "temp", "switch" or "therm", and type is the value
+# of the "type" key in the device configuration. The modules are only imported when a
+# configuration actually uses them: some of them need hardware or libraries which are not
+# present everywhere.
+#
+# Other packages can add backends without modifying this file, either by calling register(), or
+# through a "thermcontrol.backends" entry point named <kind>.<type>, e.g. in setup.cfg:
+#   [options.entry_points]
+#   thermcontrol.backends =
+#       temp.mysensor = mypackage.mymodule:MyTemp
+_registry = {
+    ("temp", "zwavejs2mqtt"): "thermlib.zwavejs2mqtt:Temp",
+    ("temp", "onewire"): "thermlib.owif:Temp",
+    ("temp", "w1sysfs"): "thermlib.w1if:Temp",
+    ("temp", "composite"): "thermlib.composite:Temp",
+    ("switch", "zwavejs2mqtt"): "thermlib.zwavejs2mqtt:Switch",
+    ("switch", "gpio"): "thermlib.pioif:PioIf",
+    ("therm", "zwavejs2mqtt"): "thermlib.zwavejs2mqtt:ThermostatSetpoint",
+}
+_entrypoints_loaded = False
+# Module name -> import time in seconds, for the backend modules we imported
+_importtimes = {}
+_modules = set()
+
+def register(kind, tp, target):
+    _registry[(kind, tp)] = target
+
+def _load_entrypoints():
+    global _entrypoints_loaded
+    if _entrypoints_loaded:
+        return
+    _entrypoints_loaded = True
+    try:
+        from importlib import metadata
+        try:
+            eps = metadata.entry_points(group="thermcontrol.backends")
+        except TypeError:
+            # Python < 3.10
+            eps = metadata.entry_points().get("thermcontrol.backends", [])
+    except Exception as e:
+        logger.debug("Could not read entry points: %s", e)
+        return
+    for ep in eps:
+        kind, sep, tp = ep.name.partition(".")
+        if sep and (kind, tp) not in _registry:
+            # Only the name is used here, the module is imported when needed
+            _registry[(kind, tp)] = ep.value
+
+def _import(modname):
+    if modname in sys.modules:
+        return sys.modules[modname]
+    start = time.perf_counter()
+    module = importlib.import_module(modname)
+    _importtimes[modname] = time.perf_counter() - start
+    logger.info("Loaded backend module %s in %.1f mS", modname, 1000 * _importtimes[modname])
+    return module
+
+# Return the class for a backend, importing its module if needed.
+def get_backend(kind, tp):
+    if (kind, tp) not in _registry:
+        _load_entrypoints()
+    if (kind, tp) not in _registry:
+        raise Exception("Unknown %s type %s" % (kind, tp))
+    target = _registry[(kind, tp)]
+    if not isinstance(target, str):
+        return target
+    modname, _, attr = target.partition(":")
+    module = _import(modname)
+    _modules.add(modname)
+    cls = getattr(module, attr)
+    _registry[(kind, tp)] = cls
+    return cls
+
+def import_times():
+    return dict(_importtimes)
+
+def _make(kind, config, name, default=None):
+    myconfig = config[name]
+    return get_backend(kind, myconfig.get("type", default))(config, myconfig)
 
 def make_temp(config, tempsensorname):
     tempconfig = config[tempsensorname]
-    if tempconfig["type"] == "zwavejs2mqtt":
-        from thermlib import zwavejs2mqtt
-        temp = zwavejs2mqtt.Temp(config, tempconfig)
-    elif tempconfig["type"] == "onewire":
-        from thermlib import owif
-        temp = owif.Temp(config, tempconfig)
-    else:
-        raise Exception("Unknown temp type %s" % tempconfig["type"])
+    temp = _make("temp", config, tempsensorname)
+    if "cachettl" in tempconfig:
+        from thermlib import sensorcache
+        cache = sensorcache.get_cache(tempconfig.get("cachedir"))
+        temp = sensorcache.CachedSensor(temp, sensorcache.make_key(tempconfig),
+                                        float(tempconfig["cachettl"]), cache)
+    # The filters are above the cache, which holds the raw values (shared with processes which may
+    # filter differently). They only see each physical sample once.
+    if "filters" in tempconfig:
+        from thermlib import filters
+        temp = filters.FilteredSensor(temp, filters.make_filter(tempconfig["filters"]))
     return temp
 
 def make_switch(config, switchsensorname):
     switchconfig = config[switchsensorname]
-    if switchconfig["type"] == "zwavejs2mqtt":
-        from thermlib import zwavejs2mqtt
-        switch = zwavejs2mqtt.Switch(config, switchconfig)
-    elif switchconfig["type"] == "gpio":
-        from thermlib import pioif
-        switch = pioif.PioIf(config, switchconfig)
-    else:
-        raise Exception("Unknown temp type %s" % switchconfig["type"])
+    switch = _make("switch", config, switchsensorname)
+    # Opt-in: the state cache is only worth it for devices with expensive commands (network)
+    if switchconfig.get("cached", False):
+        from thermlib import actuator
+        switch = actuator.CachedSwitch(switch,
+                                       float(switchconfig.get("reconcileinterval", 600)),
+                                       float(switchconfig.get("coalesceseconds", 0)))
     return switch
 
-# In our context, we only use the thermostat to retrieve the setpoint, and it's always a zwave one
+# In our context, we only use the thermostat to retrieve the setpoint, and it's normally a zwave one
 def make_therm(config, thermsensorname):
-    thermconfig = config[thermsensorname]
-    from thermlib import zwavejs2mqtt
-    therm = zwavejs2mqtt.ThermostatSetpoint(config, thermconfig)
-    return therm
+    return _make("therm", config, thermsensorname, "zwavejs2mqtt")
+
+# Let the backends which support it do their network I/O from the asyncio event loop instead of
+# their own threads. Must be called from the running loop.
+def attach_loop(loop):
+    for modname in _modules:
+        attach = getattr(sys.modules[modname], "attach_loop", None)
+        if attach:
+            attach(loop)
 
 
 if __name__ == '__main__':
     from thermlib import utils
-    import time
     def trace(s):
         print("%s" % s, file=sys.stderr)
     confname = "therm-bureau.json"
@@ -5,6 +5,8 @@ import time
 
 from thermlib import gitele
 from thermlib import conftree
+from thermlib import events
+from thermlib import schedule
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +18,7 @@ class _SetpointGetterGit(object):
         self.fetchinterval = 2*60*60
         self.giterrorcnt = 0
         self.maxgiterrors = 60
-        self.gitif = gitele.Gitele(conf)
+        self.gitif = gitele.Gitele(config)
         
     def _fetch_setpoint(self):
         try:
@@ -66,6 +68,21 @@ class _SetpointGetterTherm(object):
     def get(self):
         return self.therm.current()
 
+    def subscribe(self, callback):
+        return events.subscribe(self.therm, callback)
+
+
+# Setpoint from the week schedule in the "schedule" configuration section, see thermlib.schedule
+class _SetpointGetterSchedule(object):
+    def __init__(self, config):
+        self.getter = schedule.ScheduleGetter(config.get("schedule", {}), config.get("datarepo"))
+
+    def get(self):
+        return self.getter.get()
+
+    def subscribe(self, callback):
+        return self.getter.subscribe(callback)
+
 
 class SetpointGetter(object):
     def __init__(self, config):
@@ -75,12 +92,19 @@ class SetpointGetter(object):
             self.getter = _SetpointGetterGit(config)
         elif tp == "thermostat":
             self.getter = _SetpointGetterTherm(config)
+        elif tp == "schedule":
+            self.getter = _SetpointGetterSchedule(config)
         else:
             raise Exception("SetpointGetter: bad getter type %s" % tp)
         self.tp = tp
         scratchdir = config.get("scratchdir")
         self.uisettingfile = os.path.join(scratchdir, "ui") if scratchdir else None
-        logger.debug("SetpointGetter: uisettingfile is %s" % self.uisettingfile)
+        logger.debug("SetpointGetter: uisettingfile is %s", self.uisettingfile)
+
+    # Have callback called when the setpoint may have changed. Returns False if the getter can't
+    # do this (the caller must poll).
+    def subscribe(self, callback):
+        return events.subscribe(self.getter, callback)
         
     def get(self):
         # Always check for a local setting, it overrides the remote
@@ -89,14 +113,14 @@ class SetpointGetter(object):
                 cf = conftree.ConfSimple(self.uisettingfile)
                 tmp = cf.get("localsetting")
                 if tmp:
-                    logger.debug("SetpointGetter: returning %.1f from local ui" % float(tmp))
+                    logger.debug("SetpointGetter: returning %s from local ui", tmp)
                     return float(tmp)
             except:
                 pass
         setting = self.getter.get()
         if setting:
-            logger.debug("SetpointGetter: returning %.1f from %s getter" % (setting, self.tp))
+            logger.debug("SetpointGetter: returning %.1f from %s getter", setting, self.tp)
             return setting
         else:
-            logger.debug("SetpointGetter: returning %.1f from safe setting" % self.safetemp)
+            logger.debug("SetpointGetter: returning %.1f from safe setting", self.safetemp)
             return self.safetemp
@@ -0,0 +1,162 @@
+# On-demand profiling of the daemons, triggered by signals, for when things misbehave in the field
+# and we can't attach a debugger.
+#
+# - SIGUSR1: profile for "seconds" seconds. A thread samples the stacks of all the threads every
+#   "interval" seconds and writes them in collapsed format (one "frame;frame;frame count" line per
+#   stack, as used by flamegraph.pl or speedscope). The main thread (which runs the control loop)
+#   is also profiled with cProfile, and the pstats file and a text summary are written. A second
+#   SIGUSR1 stops the profiling early.
+# - SIGUSR2: write the stacks of all the threads (including the MQTT network thread and the git
+#   push thread) to a file.
+#
+# The files are created in the output directory, named
+# prof-<name>-<date>-<session>.{collapsed,pstats,txt} and stacks-<name>-<date>.txt.
+#
+# Nothing runs until a signal is received. The signal handlers only start or stop things, and
+# catch all errors, so that triggering them can't kill the daemon.
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import traceback
+import collections
+
+logger = logging.getLogger(__name__)
+
+
+def _framename(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+# Collapsed stack for a frame, outermost call first, prefixed with the thread name.
+def _collapse(threadname, frame):
+    names = []
+    while frame is not None:
+        names.append(_framename(frame))
+        frame = frame.f_back
+    names.append(threadname)
+    names.reverse()
+    return ";".join([n.replace(";", ":") for n in names])
+
+def _threadnames():
+    return dict([(t.ident, t.name) for t in threading.enumerate()])
+
+# Return the stacks of all the threads as text
+def thread_stacks():
+    names = _threadnames()
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append("Thread %s (%s):" % (names.get(ident, "?"), ident))
+        lines.append("".join(traceback.format_stack(frame)))
+    return "\n".join(lines)
+
+
+class SignalProfiler(object):
+    def __init__(self, outdir, name, seconds=30, interval=0.01, usecprofile=True):
+        self.outdir = outdir
+        self.name = name
+        self.seconds = seconds
+        self.interval = interval
+        self.usecprofile = usecprofile
+        self.active = False
+        self.stopevent = None
+        self.profile = None
+        self.prefix = None
+        self.sessions = 0
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self._onusr1)
+        signal.signal(signal.SIGUSR2, self._onusr2)
+        logger.info("Profiling signals installed, output in %s", self.outdir)
+
+    def _filename(self, kind, suffix):
+        return os.path.join(self.outdir, "%s-%s-%s.%s" %
+                            (kind, self.name, time.strftime("%Y%m%d-%H%M%S"), suffix))
+
+    def _onusr1(self, signum, frame):
+        try:
+            if self.active:
+                self.stop()
+            else:
+                self.start()
+        except Exception as e:
+            logger.exception("Profiling signal handler failed: %s", e)
+
+    def _onusr2(self, signum, frame):
+        try:
+            fn = self._filename("stacks", "txt")
+            with open(fn, "w") as f:
+                f.write(thread_stacks())
+            logger.warning("Thread stacks written to %s", fn)
+        except Exception as e:
+            logger.exception("Could not dump the thread stacks: %s", e)
+
+    # Start profiling. Must be called from the main thread (it is, from the signal handler).
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        self.sessions += 1
+        self.prefix = self._filename("prof", "")[:-1] + "-%d" % self.sessions
+        self.stopevent = threading.Event()
+        if self.usecprofile:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        # The sampler gets its session's prefix and stop event: an earlier sampler still winding
+        # down must not use the ones of a new session.
+        threading.Thread(target=self._sample, args=(self.prefix, self.stopevent), name="sigprof",
+                         daemon=True).start()
+        logger.warning("Profiling for %d S, output in %s.*", self.seconds, self.prefix)
+
+    # Stop profiling and write the cProfile results. Called from the main thread.
+    def stop(self):
+        if not self.active:
+            return
+        self.stopevent.set()
+        if self.profile is not None:
+            import pstats
+            self.profile.disable()
+            self.profile.dump_stats(self.prefix + ".pstats")
+            with open(self.prefix + ".txt", "w") as f:
+                stats = pstats.Stats(self.profile, stream=f)
+                stats.sort_stats("cumulative").print_stats(50)
+            self.profile = None
+        self.active = False
+
+    def _sample(self, prefix, stopevent):
+        counts = collections.Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        samples = 0
+        while time.monotonic() < deadline and not stopevent.wait(self.interval):
+            names = _threadnames()
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    counts[_collapse(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+        try:
+            with open(prefix + ".collapsed", "w") as f:
+                for stack, count in counts.most_common():
+                    print("%s %d" % (stack, count), file=f)
+            logger.warning("Profile: %d samples written to %s.collapsed", samples, prefix)
+        except Exception as e:
+            logger.error("Could not write %s.collapsed: %s", prefix, e)
+        # Have the main thread stop cProfile (it can only be stopped from the thread which
+        # started it), unless the session was already stopped (and maybe a new one started).
+        if not stopevent.is_set() and stopevent is self.stopevent:
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+
+# Install the signal handlers from the configuration: profiledir (default: scratchdir, or /tmp),
+# profileseconds, profileinterval, profilecprofile (0 to only sample the stacks).
+def setup(conf, name):
+    outdir = conf.get("profiledir") or conf.get("scratchdir") or "/tmp"
+    profiler = SignalProfiler(outdir, name, float(conf.get("profileseconds") or 30),
+                              float(conf.get("profileinterval") or 0.01),
+                              conf.get("profilecprofile") not in ("0", 0))
+    profiler.install()
+    return profiler
@@ -0,0 +1,150 @@
+# Supervision for sensor objects, so that a failing backend is repaired in the process instead of
+# exiting and waiting for the watchdog to reboot the machine.
+#
+# The supervised sensor is built by a factory function. After maxfailures consecutive read
+# errors, the circuit opens: the sensor object is closed and dropped, and reads fail immediately
+# (without touching the device) until the retry time. Then a new sensor object is built (which
+# reconnects to owserver, resubscribes to MQTT, etc.) and tried. If this fails, the retry delay
+# doubles, up to maxbackoff.
+#
+# The caller decides what to do while the sensor is failing (see degradedfor()), typically hold
+# the heater in a safe state, and exit only after some time.
+#
+# The time spent failing, the circuit openings and the rebuilds are exported as metrics, labelled
+# by sensor name.
+
+import time
+import logging
+
+from thermlib import events
+from thermlib import metrics
+
+logger = logging.getLogger(__name__)
+
+_degradedseconds = metrics.counter("therm_sensor_degraded_seconds_total",
+                                   "Time spent with a failing sensor", ["sensor"])
+_opens = metrics.counter("therm_sensor_circuit_opens_total",
+                         "Sensor circuit openings after consecutive errors", ["sensor"])
+_rebuilds = metrics.counter("therm_sensor_rebuilds_total", "Sensor object rebuilds", ["sensor"])
+
+
+class SupervisedSensor(object):
+    def __init__(self, factory, name, maxfailures=3, minbackoff=5, maxbackoff=300):
+        self.factory = factory
+        self.name = name
+        self.maxfailures = maxfailures
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.backoff = minbackoff
+        self.sensor = None
+        self.failures = 0
+        self.isopen = False
+        self.retrytime = 0
+        self.callbacks = []
+        # Start of the current failure period (monotonic), or None if we are fine
+        self.failsince = None
+        # Statistics
+        self.rebuilds = 0
+        self.errors = 0
+        self.opens = 0
+        self.degradedtime = 0.0
+        # Time up to which the degraded time was added to the metric
+        self.degradedmark = None
+        self._degradedseconds = _degradedseconds.labels(name)
+        self._opens = _opens.labels(name)
+        self._rebuilds = _rebuilds.labels(name)
+        self._build()
+
+    def _build(self):
+        try:
+            self.sensor = self.factory()
+        except Exception as e:
+            logger.error("%s: could not create sensor: %s", self.name, e)
+            self.sensor = None
+            return False
+        for callback in self.callbacks:
+            events.subscribe(self.sensor, callback)
+        return True
+
+    def _close(self):
+        close = getattr(self.sensor, "close", None)
+        if close:
+            try:
+                close()
+            except Exception as e:
+                logger.debug("%s: close failed: %s", self.name, e)
+        self.sensor = None
+
+    def _failed(self, error):
+        now = time.monotonic()
+        self.errors += 1
+        self.failures += 1
+        if self.failsince is None:
+            self.failsince = now
+            self.degradedmark = now
+        if self.isopen:
+            # A rebuilt sensor failed again
+            self.backoff = min(2 * self.backoff, self.maxbackoff)
+        if self.isopen or self.failures >= self.maxfailures:
+            if not self.isopen:
+                self.opens += 1
+                self._opens.inc()
+                logger.error("%s: %d consecutive errors, rebuilding the sensor", self.name,
+                             self.failures)
+            self.isopen = True
+            self.retrytime = now + self.backoff
+            self._close()
+
+    # Add the time spent failing since the last call to the metric
+    def _accountdegraded(self, now):
+        if self.failsince is not None:
+            self._degradedseconds.inc(now - self.degradedmark)
+            self.degradedmark = now
+
+    def current(self):
+        now = time.monotonic()
+        self._accountdegraded(now)
+        if self.isopen:
+            if now < self.retrytime:
+                raise Exception("%s: sensor failing, next retry in %d S" %
+                                (self.name, self.retrytime - now))
+            self.rebuilds += 1
+            self._rebuilds.inc()
+            logger.info("%s: rebuilding sensor", self.name)
+        if self.sensor is None and not self._build():
+            self._failed("build failed")
+            raise Exception("%s: could not create sensor" % self.name)
+        try:
+            value = self.sensor.current()
+        except Exception as e:
+            self._failed(e)
+            raise
+        if self.failsince is not None:
+            now = time.monotonic()
+            self._accountdegraded(now)
+            degraded = now - self.failsince
+            self.degradedtime += degraded
+            logger.info("%s: sensor back after %.1f S", self.name, degraded)
+        self.failures = 0
+        self.isopen = False
+        self.backoff = self.minbackoff
+        self.failsince = None
+        return value
+
+    # Seconds since the sensor started failing, 0 if it works.
+    def degradedfor(self):
+        return time.monotonic() - self.failsince if self.failsince is not None else 0
+
+    # The callbacks are kept and subscribed again to each rebuilt sensor. If the sensor could not
+    # be built yet, we can't know if it will push its values: assume it will (the backends whose
+    # creation can fail, like zwavejs2mqtt, do), the caller still polls as a fallback.
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+        if self.sensor is not None:
+            return events.subscribe(self.sensor, callback)
+        return True
+
+    def stats(self):
+        degradedtime = self.degradedtime + self.degradedfor()
+        return {"errors": self.errors, "opens": self.opens, "rebuilds": self.rebuilds,
+                "open": self.isopen, "degradedtime": degradedtime}
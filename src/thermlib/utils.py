@@ -1,22 +1,100 @@
 import logging
+import logging.handlers
 import sys
 import os
 import subprocess
 import json
+import queue
+import atexit
 
-def initlog(conf):
+_llmap = {1:logging.CRITICAL, 2:logging.ERROR, 3:logging.WARNING, 4:logging.INFO, 5:logging.DEBUG}
+
+# Convert a configuration log level (1-5) to a logging module level
+def loglevel(value, default=2):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = default
+    value = max(1, min(5, value))
+    return _llmap[value]
+
+
+# Compact structured output, one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {"t": round(record.created, 3), "l": record.levelname, "n": record.name,
+                "ln": record.lineno, "m": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["x"] = record.exc_text
+        return json.dumps(data)
+
+
+# Types which can't change between the logging call and the formatting by the listener thread.
+_immutable = (str, int, float, bool, bytes, type(None))
+
+# Queue handler which does not format the message in the calling thread (the standard one does),
+# unless some arguments are mutable objects, which could change before the listener formats them.
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        args = record.args
+        if args and not (isinstance(args, tuple) and
+                         all([isinstance(arg, _immutable) for arg in args])):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks keep the frames alive, format them now.
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Log file handler, with size (logmaxbytes) or time (logrotatewhen, e.g. "midnight") rotation
+# keeping logbackupcount old files, and text or JSON (logformat) output.
+def logfilehandler(conf):
     logfilename = conf.get('logfilename') or "/tmp/therm_log.txt"
-    loglevel = conf.get('loglevel') or 2
-    loglevel = int(loglevel)
-    if loglevel > 5:
-        loglevel = 5
-    if loglevel < 1:
-        loglevel = 1 
-    llmap = {1:logging.CRITICAL, 2:logging.ERROR, 3:logging.WARNING,
-             4:logging.INFO, 5:logging.DEBUG}
-    loglevel = llmap[loglevel] if loglevel in llmap else logging.WARNING
-    logging.basicConfig(filename=logfilename, level=loglevel,
-                        format='%(asctime)s - %(name)s:%(lineno)d: %(message)s')
+    backupcount = int(conf.get('logbackupcount') or 5)
+    rotatewhen = conf.get('logrotatewhen')
+    maxbytes = int(conf.get('logmaxbytes') or 0)
+    if rotatewhen:
+        handler = logging.handlers.TimedRotatingFileHandler(logfilename, when=rotatewhen,
+                                                            backupCount=backupcount)
+    elif maxbytes:
+        handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes=maxbytes,
+                                                       backupCount=backupcount)
+    else:
+        handler = logging.FileHandler(logfilename)
+    if conf.get('logformat') == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s:%(lineno)d: %(message)s'))
+    return handler
+
+_loglistener = None
+
+# Set up logging from the configuration. The records are put on a queue by the calling threads
+# (asyncio loop, paho network thread...), and formatted and written by a single listener thread,
+# so that logging calls never wait for the disk. logqueue = 0 writes from the calling threads
+# instead. logmodulelevels sets the level for some loggers, e.g. {"thermlib.zwavejs2mqtt": 3}.
+def initlog(conf):
+    global _loglistener
+    root = logging.getLogger()
+    root.setLevel(loglevel(conf.get('loglevel')))
+    handler = logfilehandler(conf)
+    usequeue = conf.get('logqueue')
+    if usequeue is None or int(usequeue):
+        logqueue = queue.SimpleQueue()
+        _loglistener = logging.handlers.QueueListener(logqueue, handler)
+        _loglistener.start()
+        atexit.register(_loglistener.stop)
+        handler = LazyQueueHandler(logqueue)
+    root.addHandler(handler)
+    modulelevels = conf.get('logmodulelevels') or {}
+    if isinstance(modulelevels, str):
+        modulelevels = json.loads(modulelevels)
+    for name, level in modulelevels.items():
+        logging.getLogger(name).setLevel(loglevel(level))
 
 def pidw(pidfile):
     data = None
@@ -31,7 +109,7 @@ def pidw(pidfile):
         beg = pid + " "
         for line in pso.split("\n"):
             if line.startswith(beg):
-                logger.warning("Already running. pid: %s" % pid)
+                logger.warning("Already running. pid: %s", pid)
                 sys.exit(1)
     with open(pidfile, "w") as f:
         print("%d" % os.getpid(), file=f)
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+# Direct access to 1-wire temperature sensors through the Linux kernel w1 sysfs interface
+# (w1-gpio and w1-therm modules), without going through owserver. This is the simplest setup on a
+# Raspberry PI with the sensors connected to a GPIO pin.
+#
+# Each sensor has a directory /sys/bus/w1/devices/28-0300a2792076/, where reading w1_slave
+# triggers a conversion and returns something like:
+#   72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+#   72 01 4b 46 7f ff 0e 10 57 t=23125
+#
+# Recent kernels also have a therm_bulk_read file in the bus master directory: writing "trigger"
+# to it starts a conversion on all the sensors of the bus at once, and the results can then be
+# read from each sensor "temperature" file, without waiting a conversion time for each of them.
+
+import os
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+w1dir = '/sys/bus/w1/devices'
+
+# Convert a sensor id to the sysfs format. The sysfs and owfs ids have inverse byte orders, see
+# the comments in owif.py:
+# /sys/bus/w1/devices/ : 28-0300a2792076
+# /run/owfs/ :           28.762079A20003
+def id_sysfs(inid):
+    if inid[2] == '-':
+        return inid
+    if len(inid) == 16:
+        # Old tcl one
+        return inid[14:16] + '-' + inid[2:14].lower()
+    outid = inid[0:2] + '-'
+    for i in range(6):
+        base = 3 + 2 * (6-i) - 2
+        outid += inid[base : base+2].lower()
+    return outid
+
+# Parse the contents of a w1_slave file, checking the crc, and return the temperature as float
+def parse_w1_slave(data):
+    lines = data.split('\n')
+    if len(lines) < 2 or not lines[0].strip().endswith('YES'):
+        raise Exception("Bad crc [%s]" % lines[0].strip())
+    _, sep, value = lines[1].rpartition('t=')
+    if not sep:
+        raise Exception("No temperature in [%s]" % lines[1].strip())
+    return int(value) / 1000.0
+
+# Read the temperature from a sensor directory, triggering a conversion.
+def readtemp(devdir):
+    with open(os.path.join(devdir, 'w1_slave'), 'r') as f:
+        data = f.read()
+    value = parse_w1_slave(data)
+    logger.debug("readtemp %s -> %s", devdir, value)
+    return value
+
+# Read the temperature latched by a bulk conversion. Returns None if there is no value (no bulk
+# conversion done or kernel without the feature).
+def readlatched(devdir):
+    try:
+        with open(os.path.join(devdir, 'temperature'), 'r') as f:
+            data = f.read().strip()
+    except Exception:
+        return None
+    if not data:
+        return None
+    value = int(data) / 1000.0
+    logger.debug("readlatched %s -> %s", devdir, value)
+    return value
+
+
+# A temperature value computed as the average of one or several sensors. This has the same
+# interface and behaviour as owif.Temp: the sensors are read in parallel, failed sensors are left
+# out of the average and reported in the quality member.
+class Temp(object):
+    def __init__(self, config, myconfig):
+        self.ids = myconfig["ids"]
+        self.w1dir = myconfig.get("w1dir", w1dir)
+        self.devdirs = [os.path.join(self.w1dir, id_sysfs(id)) for id in self.ids]
+        self.bulktimeout = float(myconfig.get("bulktimeout", 1.5))
+        self.executor = None
+        if len(self.devdirs) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=min(len(self.devdirs), 8))
+        # Per-sensor result of the last read: devdir -> {"value", "ok", "error", "time"}
+        self.quality = {}
+        # Bus masters for our sensors which support the bulk read
+        self.bulkfiles = set()
+        for devdir in self.devdirs:
+            if not os.path.isdir(devdir):
+                logger.error("Sensor directory %s not found", devdir)
+                continue
+            if myconfig.get("bulk", True):
+                master = os.path.dirname(os.path.realpath(devdir))
+                bulkfile = os.path.join(master, 'therm_bulk_read')
+                if os.path.exists(bulkfile):
+                    self.bulkfiles.add(bulkfile)
+        logger.debug("w1if.Temp: sensors %s bulk %s", self.devdirs, self.bulkfiles)
+
+    # Start a conversion on all the buses and wait for it to complete. Returns True if the
+    # latched values can be read.
+    def _bulkconvert(self):
+        try:
+            for bulkfile in self.bulkfiles:
+                with open(bulkfile, 'w') as f:
+                    f.write('trigger\n')
+            deadline = time.monotonic() + self.bulktimeout
+            pending = set(self.bulkfiles)
+            while pending:
+                for bulkfile in list(pending):
+                    with open(bulkfile, 'r') as f:
+                        # -1: conversion in progress
+                        if f.read().strip() != '-1':
+                            pending.discard(bulkfile)
+                if not pending:
+                    break
+                if time.monotonic() > deadline:
+                    raise Exception("timeout waiting for %s" % pending)
+                time.sleep(0.05)
+            return True
+        except Exception as e:
+            logger.error("Bulk conversion failed, reading sensors one by one: %s", e)
+            return False
+
+    def _readone(self, devdir, latched):
+        try:
+            value = readlatched(devdir) if latched else None
+            if value is None:
+                value = readtemp(devdir)
+            result = {"value": value, "ok": True, "error": None}
+        except Exception as e:
+            logger.error("Could not read temperature from %s: %s", devdir, e)
+            result = {"value": None, "ok": False, "error": str(e)}
+        result["time"] = time.time()
+        return devdir, result
+
+    def readall(self):
+        latched = self._bulkconvert() if self.bulkfiles else False
+        if self.executor:
+            results = self.executor.map(lambda d: self._readone(d, latched), self.devdirs)
+        else:
+            results = [self._readone(d, latched) for d in self.devdirs]
+        self.quality = dict(results)
+        return self.quality
+
+    def current(self):
+        values = [r["value"] for r in self.readall().values() if r["ok"]]
+        if not values:
+            raise Exception("w1if.Temp: could not read any of %s" % self.devdirs)
+        if len(values) != len(self.devdirs):
+            logger.warning("w1if.Temp: only %d of %d sensors read", len(values),
+                           len(self.devdirs))
+        return sum(values) / len(values)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+##########
+if __name__ == '__main__':
+    def perr(s):
+        print("%s"%s, file=sys.stderr)
+    def usage():
+        perr("Usage: w1if.py <id> [<id> ...]")
+        sys.exit(1)
+    if len(sys.argv) < 2:
+        usage()
+    temp = Temp({}, {"ids": sys.argv[1:]})
+    print("Temp: %.2f" % temp.current())
+    for devdir, result in temp.quality.items():
+        print("%s: %s" % (devdir, result))
+    sys.exit(0)
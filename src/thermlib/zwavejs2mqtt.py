@@ -1,33 +1,389 @@
 #!/usr/bin/python3
-import sys
 import time
-import datetime
+import asyncio
 import json
 import logging
+import threading
+import collections
+import functools
 
 import paho.mqtt.client as mqtt
 
+from thermlib import metrics
+
 logger = logging.getLogger(__name__)
 
-_values = {}
+# A read is only a dictionary lookup: what matters is how old the value returned is.
+_valueage = metrics.histogram("therm_sensor_value_age_seconds",
+                              "Time since the reception of the value returned by a sensor read",
+                              ["backend"], buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600,
+                                                    10800)).labels("zwavejs2mqtt")
+_readerrors = metrics.counter("therm_sensor_read_errors_total", "Sensor read errors",
+                              ["backend"]).labels("zwavejs2mqtt")
+_confirmseconds = metrics.histogram("therm_switch_confirm_seconds",
+                                    "Time from switch command to device confirmation",
+                                    ["backend"]).labels("zwavejs2mqtt")
+_switcherrors = metrics.counter("therm_switch_errors_total", "Switch commands not confirmed",
+                                ["backend"]).labels("zwavejs2mqtt")
+
+# Decoded value for a topic. The message payload is parsed once on arrival.
+class _Value(object):
+    __slots__ = ("value", "time", "rxtime")
+    def __init__(self, value, time, rxtime):
+        # The value itself
+        self.value = value
+        # Source timestamp (seconds since the epoch) if the gateway sent one, else None
+        self.time = time
+        # time.monotonic() when we received the message
+        self.rxtime = rxtime
+
+
+# Store for the last values received on the subscribed topics, with an optional bounded history
+# for some topics.
+class ValueStore(object):
+    def __init__(self):
+        self.values = {}
+        self.histories = {}
+        self.messages = 0
+        self.errors = 0
+
+    def sethistory(self, topic, size):
+        if size:
+            self.histories[topic] = collections.deque(maxlen=size)
+
+    def ingest(self, topic, payload, convert=None):
+        self.messages += 1
+        try:
+            data = json.loads(payload)
+        except Exception:
+            self.errors += 1
+            logger.error("Could not decode payload for %s: %s", topic, payload)
+            return None
+        # The gateway normally sends {"time": ms, "value": v}, but it can be configured to send
+        # the plain value
+        if isinstance(data, dict) and "value" in data:
+            tm = data.get("time")
+            tm = tm / 1000.0 if tm else None
+            data = data["value"]
+        else:
+            tm = None
+        if convert is not None and data is not None:
+            try:
+                data = convert(data)
+            except Exception:
+                self.errors += 1
+                logger.error("Bad value for %s: %s", topic, data)
+                return None
+        value = _Value(data, tm, time.monotonic())
+        self.values[topic] = value
+        history = self.histories.get(topic)
+        if history is not None:
+            history.append(value)
+        return value
+
+    def get(self, topic):
+        return self.values.get(topic)
+
+    def history(self, topic):
+        history = self.histories.get(topic)
+        return list(history) if history is not None else []
+
+    # Seconds since we last received a value for topic, or None if we never did
+    def age(self, topic):
+        value = self.values.get(topic)
+        return time.monotonic() - value.rxtime if value else None
+
+
+# Value types for the command classes we use. Values for other classes are stored as decoded
+# from the JSON payload.
+_cctypes = {
+    37: bool,   # Binary switch
+    49: float,  # Multilevel sensor
+    67: float,  # Thermostat setpoint
+}
+
+class _TrieNode(object):
+    __slots__ = ("children", "entries")
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+
+
+# Topic trie, mapping MQTT topics or topic filters (with + and # wildcards) to entries.
+class TopicTrie(object):
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def insert(self, pattern, entry):
+        node = self.root
+        for level in pattern.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TrieNode()
+            node = child
+        if entry not in node.entries:
+            node.entries.append(entry)
+
+    def remove(self, pattern, entry):
+        node = self.root
+        for level in pattern.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return
+        if entry in node.entries:
+            node.entries.remove(entry)
+
+    # Return the entries for all the patterns matching topic
+    def match(self, topic):
+        result = []
+        levels = topic.split("/")
+        nlevels = len(levels)
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            # '#' matches the parent level and everything below
+            hashnode = node.children.get("#")
+            if hashnode is not None:
+                result.extend(hashnode.entries)
+            if i == nlevels:
+                result.extend(node.entries)
+                continue
+            child = node.children.get(levels[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            child = node.children.get("+")
+            if child is not None:
+                stack.append((child, i + 1))
+        return result
+
+
+# Routes the incoming messages to the registered topics. The MQTT subscriptions use wildcards, one
+# per prefix and command class (e.g. zwave/+/49/#), instead of one per topic. Messages for topics
+# with no registration are dropped without being decoded. For registered topics, the payload is
+# decoded once and stored, then the handlers are called with the decoded value.
+class Dispatcher(object):
+    def __init__(self, store):
+        self.store = store
+        self.trie = TopicTrie()
+        self.subscriptions = set()
+        # The registrations are made from the main thread, while the messages may be processed by
+        # paho's network thread (until attach_loop()): protects the trie and the subscriptions.
+        self.lock = threading.Lock()
+        self.dropped = 0
+        # topic -> list of (loop, future) for the coroutines waiting for a new value
+        self.waiters = {}
+
+    # Register interest in a topic for command class cc. handler, if set, is called as
+    # handler(topic, value) for each new value.
+    def register(self, client, topic, prefix, cc, handler=None, wildcard=True):
+        sub = "%s/+/%d/#" % (prefix, cc) if wildcard else topic
+        with self.lock:
+            self.trie.insert(topic, (_cctypes.get(cc), handler))
+            new = sub not in self.subscriptions
+            if new:
+                self.subscriptions.add(sub)
+        if new:
+            client.subscribe(sub)
+
+    # Add a handler for an already registered topic
+    def addhandler(self, topic, cc, handler):
+        with self.lock:
+            self.trie.insert(topic, (_cctypes.get(cc), handler))
+
+    def removehandler(self, topic, cc, handler):
+        with self.lock:
+            self.trie.remove(topic, (_cctypes.get(cc), handler))
+
+    def dispatch(self, topic, payload):
+        with self.lock:
+            entries = self.trie.match(topic)
+        if not entries:
+            self.dropped += 1
+            return None
+        value = self.store.ingest(topic, payload, entries[0][0])
+        if value is None:
+            return None
+        for convert, handler in entries:
+            if handler is not None:
+                try:
+                    handler(topic, value)
+                except Exception:
+                    logger.exception("Handler failed for %s", topic)
+        waiters = self.waiters.pop(topic, None)
+        if waiters:
+            for loop, future in waiters:
+                if loop is _running_loop():
+                    _setresult(future, value)
+                else:
+                    loop.call_soon_threadsafe(_setresult, future, value)
+        return value
+
+    # Subscribe again after a reconnection (we use a clean session)
+    def resubscribe(self, client):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for sub in subscriptions:
+            client.subscribe(sub)
+
+    # Wait for the next value on topic. Returns the value, or raises asyncio.TimeoutError.
+    async def wait(self, topic, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        self.waiters.setdefault(topic, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # Timed out or cancelled: forget the waiter (dispatch() removes the list when a value
+            # arrives)
+            waiters = self.waiters.get(topic)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters and self.waiters.get(topic) is waiters:
+                    del self.waiters[topic]
+
+
+def _setresult(future, value):
+    if not future.done():
+        future.set_result(value)
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+# Drives the paho client from an asyncio event loop instead of paho's own network thread, using
+# the external loop API: the loop watches the client socket and calls loop_read/loop_write, and
+# we call loop_misc every second for keepalives. The messages are then processed on the event loop
+# thread. If the connection is lost, we reconnect from the misc callback. The reconnection (name
+# resolution and TCP connection) can block for a long time, so it runs in an executor thread.
+# See https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+class _AsyncioHelper(object):
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.sock = None
+        self.reconnectdelay = 1
+        self.loopthread = threading.get_ident()
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        sock = client.socket()
+        if sock:
+            self.on_socket_open(client, None, sock)
+            if client.want_write():
+                self.on_socket_register_write(client, None, sock)
+        self.mischandle = loop.call_later(1, self.misc)
+
+    # The socket callbacks are called from the reconnection thread too: the loop must only be
+    # modified from its own thread.
+    def _onloop(self, func, *args):
+        if threading.get_ident() == self.loopthread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._onloop(self._open, client, sock)
+
+    def _open(self, client, sock):
+        self.sock = sock
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._onloop(self._close, sock)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.sock is sock:
+            self.sock = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._onloop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._onloop(self.loop.remove_writer, sock)
+
+    def misc(self):
+        if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+            logger.info("MQTT connection lost, reconnecting")
+            # misc is rescheduled when the reconnection is done
+            future = self.loop.run_in_executor(None, self.client.reconnect)
+            future.add_done_callback(self._reconnected)
+            return
+        self.mischandle = self.loop.call_later(1, self.misc)
+
+    def _reconnected(self, future):
+        delay = 1
+        try:
+            future.result()
+            self.reconnectdelay = 1
+        except Exception as e:
+            logger.error("MQTT reconnect failed: %s", e)
+            self.reconnectdelay = min(2 * self.reconnectdelay, 60)
+            delay = self.reconnectdelay
+        self.mischandle = self.loop.call_later(delay, self.misc)
+
+    # Process network events for up to timeout seconds without returning to the event loop. Used
+    # by the synchronous code running on the loop thread which waits for a message.
+    def poll(self, timeout):
+        self.client.loop(timeout=timeout)
+
+
+_store = ValueStore()
+_dispatcher = Dispatcher(_store)
 _client = None
+_asynchelper = None
 
 def _on_message(client, userdata, message):
-    logger.debug("topic %s qos %s retain %s payload %s", 
-                 message.topic, message.qos, message.retain, message.payload.decode("utf-8"))
-    global _values
-    _values[message.topic] = message.payload
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("topic %s qos %s retain %s payload %s", 
+                     message.topic, message.qos, message.retain, message.payload)
+    _dispatcher.dispatch(message.topic, message.payload)
+
+def _on_connect(client, userdata, flags, rc):
+    logger.info("MQTT connected, rc %s", rc)
+    _dispatcher.resubscribe(client)
+
+# Common code for the device objects
+def _register(client, mqttconfig, myconfig, topic, handler=None):
+    _dispatcher.register(client, topic, _confget(myconfig, "prefix", "zwave"), myconfig["cc"],
+                         handler, _confget(mqttconfig, "wildcard", True))
     
 def _get_client(id, host, port=1883):
     global _client
     if not _client:
         _client = mqtt.Client(client_id=id, clean_session=True)
         _client.on_message = _on_message
+        _client.on_connect = _on_connect
         _client.connect(host, port=port)
         # See https://www.eclipse.org/paho/index.php?page=clients/python/docs/index.php#network-loop
+        # We start with paho's network thread, attach_loop() switches to the asyncio loop.
         _client.loop_start()
     return _client
 
+# Switch the MQTT client (shared by all the devices) from paho's network thread to the given
+# asyncio loop, which must be the running one.
+def attach_loop(loop):
+    global _asynchelper
+    if not _client or _asynchelper:
+        return
+    _client.loop_stop()
+    _asynchelper = _AsyncioHelper(loop, _client)
+    logger.debug("MQTT client now driven by the asyncio loop")
+
+# Wait for seconds, processing the MQTT messages if they are delivered by the asyncio loop and we
+# are running on it (else the loop would be blocked and no message would come).
+def _sleep(seconds):
+    if _asynchelper and _running_loop() is _asynchelper.loop:
+        _asynchelper.poll(seconds)
+    else:
+        time.sleep(seconds)
+
 def _set_value(client, nodeid, cc, endpoint, property, value):
     # The following is documented here:
     # https://zwave-js.github.io/zwavejs2mqtt/#/guide/mqtt?id=api-call-examples  # Set values
@@ -57,6 +413,7 @@ def _confget(conf, param, default):
 # Note that this supposes that the MQTT Gateway is configured to use node names in topics (which I
 # think is the default), and that no names are actually set. Else we'd need to either use the name
 # or the numeric value instead of nodeID_xx.
+@functools.lru_cache(maxsize=None)
 def _make_topic(prefix, nodeid, cc, endpoint, property, propertyKey=None):
     topic = "%s/nodeID_%d/%d/%d/%s" % (prefix, nodeid, cc, endpoint, property)
     if propertyKey:
@@ -79,18 +436,54 @@ class Temp(object):
         port = mqttconfig["port"] if "port" in mqttconfig else 1883
         self.client = _get_client(mqttconfig["clientid"], mqttconfig["host"], port)
         self.topic = _make_topic_from_config(myconfig, "property_current")
-        self.client.subscribe(self.topic)
+        # Values older than this (seconds) are considered stale: the node is probably dead.
+        # 0 to disable the check.
+        self.maxage = float(_confget(myconfig, "maxage", 3 * 3600))
+        self.cc = myconfig["cc"]
+        self.handlers = []
+        _store.sethistory(self.topic, int(_confget(myconfig, "history", 0)))
+        _register(self.client, mqttconfig, myconfig, self.topic)
 
     def current(self):
-        global _values
-        if self.topic in _values:
-            data = json.loads(_values[self.topic])
-            dt = datetime.datetime.fromtimestamp(data["time"]/1000)
-            logger.debug("Temp:%s value %f (%s)", self.topic, data["value"], dt)
-            return data["value"]
-        else:
-            logger.debug("Temp: no data yet for %s", self.topic)
-            return 20.0
+        now = time.monotonic()
+        data = _store.get(self.topic)
+        if data is None:
+            _readerrors.inc()
+            raise Exception("Temp: no data yet for %s" % self.topic)
+        age = now - data.rxtime
+        if self.maxage and age > self.maxage:
+            _readerrors.inc()
+            raise Exception("Temp: stale data for %s (%d S old)" % (self.topic, age))
+        logger.debug("Temp:%s value %s (%s)", self.topic, data.value, data.time)
+        _valueage.observe(age)
+        return data.value
+
+    def age(self):
+        return _store.age(self.topic)
+
+    # Have callback(value) called for each new reading. This is called from the thread which
+    # processes the MQTT messages.
+    def subscribe(self, callback):
+        handler = lambda topic, data: callback(data.value)
+        self.handlers.append(handler)
+        _dispatcher.addhandler(self.topic, self.cc, handler)
+        return True
+
+    # Called when the object is dropped (e.g. by the supervisor before building a new one).
+    # Subscribing again makes the broker send us the retained values.
+    def close(self):
+        for handler in self.handlers:
+            _dispatcher.removehandler(self.topic, self.cc, handler)
+        self.handlers = []
+        _dispatcher.resubscribe(self.client)
+
+    # Coroutine: wait for the next reading and return it.
+    async def next_value(self, timeout=None):
+        data = await _dispatcher.wait(self.topic, timeout)
+        return data.value
+
+    def history(self):
+        return _store.history(self.topic)
 
 
 class Switch(object):
@@ -101,19 +494,17 @@ class Switch(object):
         port = mqttconfig["port"] if "port" in mqttconfig else 1883
         self.client = _get_client(mqttconfig["clientid"], mqttconfig["host"], port)
         self.topic = _make_topic_from_config(myconfig, "property_current")
-        self.client.subscribe(self.topic)
+        _register(self.client, mqttconfig, myconfig, self.topic)
         self.prefix = _confget(myconfig,"prefix", "zwave")
         self.nodeid = myconfig["nodeid"]
         self.cc = myconfig["cc"]
         self.endpoint = myconfig["endpoint"]
 
     def current(self):
-        global _values
-        if self.topic in _values:
-            data = json.loads(_values[self.topic])
-            dt = datetime.datetime.fromtimestamp(data["time"]/1000)
-            logger.debug("Switch:%s value %s (%s)", self.topic, data["value"], dt)
-            return data["value"]
+        data = _store.get(self.topic)
+        if data is not None:
+            logger.debug("Switch:%s value %s (%s)", self.topic, data.value, data.time)
+            return data.value
         else:
             logger.debug("Switch: no data yet for %s", self.topic)
             return False
@@ -123,14 +514,16 @@ class Switch(object):
         self.set(False)
     def set(self, state):
         property = "targetValue"
+        start = time.monotonic()
         _set_value(self.client, self.nodeid, self.cc,self.endpoint, property, state)
         loopcnt = 30
         loopslp = 0.1
         for i in range(loopcnt):
-            time.sleep(loopslp)
+            _sleep(loopslp)
             if self.current() == state:
+                _confirmseconds.observe(time.monotonic() - start)
                 return True
-            print("DOing some IO", file=sys.stderr)
+        _switcherrors.inc()
         raise Exception("Switch: not %s after %d S" % (state, int(loopcnt*loopslp)))
 
 
@@ -144,15 +537,19 @@ class ThermostatSetpoint(object):
         port = mqttconfig["port"] if "port" in mqttconfig else 1883
         self.client = _get_client(mqttconfig["clientid"], mqttconfig["host"], port)
         self.topic = _make_topic_from_config(myconfig, "property_current", "setpoint")
-        self.client.subscribe(self.topic)
+        self.cc = myconfig["cc"]
+        _register(self.client, mqttconfig, myconfig, self.topic)
+
+    # Have callback(value) called for each new setpoint value.
+    def subscribe(self, callback):
+        _dispatcher.addhandler(self.topic, self.cc, lambda topic, data: callback(data.value))
+        return True
 
     def current(self):
-        global _values
-        if self.topic in _values:
-            data = json.loads(_values[self.topic])
-            dt = datetime.datetime.fromtimestamp(data["time"]/1000)
-            logger.debug("ThermostatSetpoint:%s value %s (%s)", self.topic, data["value"], dt)
-            return data["value"]
+        data = _store.get(self.topic)
+        if data is not None:
+            logger.debug("ThermostatSetpoint:%s value %s (%s)", self.topic, data.value, data.time)
+            return data.value
         else:
             logger.debug("ThermostatSetpoint: no data yet for %s", self.topic)
             return False
@@ -162,8 +559,6 @@ class ThermostatSetpoint(object):
 if __name__ == "__main__":
     import utils
     import os
-    import sys
-    import logging
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s - %(name)s:%(lineno)d: %(message)s')
     confname = None
@@ -7,8 +7,13 @@ import logging
 import datetime
 import time
 
+from thermlib import metrics
+
 logger = logging.getLogger(__name__)
 
+_writeseconds = metrics.histogram("therm_statelog_write_seconds", "State log write time")
+_writeerrors = metrics.counter("therm_statelog_errors_total", "State log write errors")
+
 class StateLogger(object):
     def __init__(self, datarepo, period = 5 * 60):
         self.datarepo = datarepo
@@ -40,11 +45,14 @@ class StateLogger(object):
     
         data = [tm, values]
         line = json.dumps(data)
+        start = time.monotonic()
         try:
             with open(logfilename, 'a') as f:
                 print("%s" % line, file=f)
         except:
+            _writeerrors.inc()
             logger.exception("Logging temp error")
+        _writeseconds.observe(time.monotonic() - start)
 
 
 ##########
@@ -13,6 +13,15 @@ from thermlib import PID
 from thermlib import gitele
 from thermlib import sensorfact
 from thermlib import setpoint
+from thermlib import events
+from thermlib import sampling
+from thermlib import supervisor
+from thermlib import checkpoint
+from thermlib import scheduler
+from thermlib import pwm
+from thermlib import metrics
+from thermlib import loopmon
+from thermlib import sigprof
 
 import thermlog
 
@@ -33,30 +42,37 @@ class Publisher(object):
         now = time.time()
         if not force and (now < self.last_world_update + self.publish_interval):
             return
-        if self.update_thread and self.update_thread.isAlive():
-            log.info("maybe_tell_the_world: previous update not done")
+        if self.update_thread and self.update_thread.is_alive():
+            logger.info("maybe_tell_the_world: previous update not done")
             return
         self.last_world_update = now
         self.update_thread = threading.Thread(target=self.tell_the_world)
         self.update_thread.start()
 
 
-# Retrieving the temperature from the sensor. If this fails too much, we exit, hoping that a system
-# restart (done by the watchdog) will improve things.
+# Retrieving the temperature from the sensor. The sensor is supervised (see
+# thermlib.supervisor), so it gets rebuilt if it keeps failing. If we still can't get a value after
+# failbudget seconds, we exit, hoping that a system restart (done by the watchdog) will improve
+# things.
 class TempGetter(object):
-    def __init__(self, thermsensor, tempscratch):
+    def __init__(self, thermsensor, tempscratch, failbudget=1800):
         self.thermsensor = thermsensor
         self.tempscratch = tempscratch
-        self.temperrorcnt = 0
+        self.failbudget = failbudget
+        self.failsince = None
+        self.tempscratchdata = None
 
     # Retrieve the interior temperature
     def _gettemp(self):
         temp = self.thermsensor.current()
         logger.debug("Current temperature %.1f ", temp)
-        if self.tempscratch:
+        # Only rewrite the scratch file when the displayed value changes
+        data = "measuredtemp = %.1f" % temp
+        if self.tempscratch and data != self.tempscratchdata:
             try:
                 with open(self.tempscratch, "w") as f:
-                    print("measuredtemp = %.1f" % temp, file=f)
+                    print(data, file=f)
+                self.tempscratchdata = data
             except:
                 pass
         return temp
@@ -64,22 +80,28 @@ class TempGetter(object):
     def gettemp(self):
         try:
             temp = self._gettemp()
-        except:
-            logger.error("Could not get temp")
-            self.temperrorcnt += 1
-            if self.temperrorcnt < 5:
+        except Exception as e:
+            logger.error("Could not get temp: %s", e)
+            now = time.monotonic()
+            if self.failsince is None:
+                self.failsince = now
+            if now - self.failsince < self.failbudget:
                 return None
             else:
                 # Exit and let upper layers handle the situation (reboot?)
-                logger.critical("Too many temp reading errors, exiting")
+                logger.critical("No temperature for %d S, exiting", now - self.failsince)
                 sys.exit(1)
-        self.temperrorcnt = 0
+        self.failsince = None
         return temp
 
+    def subscribe(self, callback):
+        return events.subscribe(self.thermsensor, callback)
+
 
 class PidLoop(object):
     def __init__(self, statelogger, switch, setpointgetter, tempgetter, world_publisher,
-                 heatingperiod, kp, ki, kd):
+                 heatingperiod, kp, ki, kd, eventconfig={}, safecommand=0,
+                 checkpointfile=None, checkpointmaxage=0):
         self.statelogger = statelogger
         self.switch = switch
         self.setpointgetter = setpointgetter
@@ -89,33 +111,75 @@ class PidLoop(object):
         self.kp = kp
         self.ki = ki
         self.kd = kd
+        # Command (0-100) used while we can't read the temperature
+        self.safecommand = safecommand
 
         # We loop every minute to test things to do (maybe log, turn off heater or whatever)
         self.fastloopseconds = 60
+        # Actual polling interval. This is set longer in event-driven mode.
+        self.pollseconds = self.fastloopseconds
+        self.eventconfig = eventconfig
+        self.trigger = None
 
         self.heatseconds = 0
         self.setpoint = 10.0
         self.command = 0
+        self.actualtemp = None
         self.pidctl = None
-        self.turnoffhandle = None
-        self.slowhandle = None
+        # Heating periods ("period" key) and heater turn off ("heater" key) are scheduled on the
+        # monotonic clock. periodstart is the start of the current period in this clock,
+        # heatperiodstart the same in wall clock time, for the checkpoints.
+        self.timers = scheduler.ActuationScheduler()
         self.switch.turnoff()
+        self.periodstart = None
         self.heatperiodstart = time.time()
-        
+
+        # The PID integral term takes many periods to converge, so we save the controller state
+        # after each step, and restore it when restarting, if it is recent enough.
+        self.checkpointfile = checkpointfile
+        self.restored = None
+        if checkpointfile:
+            self.restored = checkpoint.load_state(checkpointfile, checkpointmaxage)
+
+    # Event-driven mode: if the temperature or setpoint sensors push their updates, we react when
+    # they arrive (debounced and rate-limited), stepping the PID and updating the heater at once,
+    # and only poll every eventpollseconds as a fallback. Else we poll every fastloopseconds.
+    def setup_events(self, loop):
+        if not self.eventconfig.get("eventdriven", True):
+            return
+        self.trigger = events.Trigger(loop, self.react,
+                                      float(self.eventconfig.get("eventdebounce", 1.0)),
+                                      float(self.eventconfig.get("eventmininterval", 10.0)))
+        pushtemp = self.tempgetter.subscribe(self.trigger.fire)
+        pushsetpoint = self.setpointgetter.subscribe(self.trigger.fire)
+        if pushtemp:
+            self.pollseconds = float(self.eventconfig.get("eventpollseconds", 300))
+        logger.info("Event-driven: temp %s setpoint %s, polling every %d S",
+                    pushtemp, pushsetpoint, self.pollseconds)
+
     def fastcallback(self):
         # Schedule next call
         loop = asyncio.get_running_loop()
-        loop.call_later(self.fastloopseconds, self.fastcallback)
+        loop.call_later(self.pollseconds, self.fastcallback)
+        self.evaluate()
 
-        timeinperiod = time.time() - self.heatperiodstart
+    # Read the temperature and the setpoint. Returns True if the heating periods were
+    # (re)started, which steps the PID.
+    def refresh(self):
+        timeinperiod = self.timers.time() - self.periodstart if self.periodstart else 0
         logger.debug("timeinperiod %d heatseconds %d / %d",
                      timeinperiod, self.heatseconds, self.heatingperiod)
     
         # Retrieve the temperature. We do it in the fast loop for logging purposes. gettemp will
-        # exit the process if there are too many errors. The watchdog will then notice and reboot.
+        # exit the process if it fails for too long. The watchdog will then notice and reboot.
+        # Meanwhile, slowcallback uses the safe command. Make sure that it runs even if we never
+        # got a temperature.
         self.actualtemp = self.tempgetter.gettemp()
         if self.actualtemp is None:
-            return
+            if not self.timers.pending("period"):
+                self.timers.periodic("period", self.heatingperiod, self.slowcallback)
+                return True
+            return False
 
         # First call or setpoint change: need to create/change the PID object and
         # schedule/reschedule the slow callback
@@ -125,10 +189,21 @@ class PidLoop(object):
             self.pidctl = PID.PID(Kp=self.kp, Ki=self.ki, Kd=self.kd, setpoint=nsetpoint,
                                   output_limits=(0, 100), sample_time=None,
                                   auto_mode=True, proportional_on_measurement=False)
-            logger.debug("PID tunings: Kp %.2f Ki %.2f Kd %.2f" % self.pidctl.tunings)
-            if self.slowhandle:
-                self.slowhandle.cancel()
-            self.slowhandle = loop.call_soon(self.slowcallback)
+            logger.debug("PID tunings: Kp %.2f Ki %.2f Kd %.2f", *self.pidctl.tunings)
+            self.timers.cancel("period")
+            if self.restored:
+                self.restore(self.restored)
+                self.restored = None
+            else:
+                self.timers.periodic("period", self.heatingperiod, self.slowcallback)
+            return True
+        return False
+
+    # Periodic evaluation: refresh the values, log our state and publish it from time to time.
+    def evaluate(self):
+        self.refresh()
+        if self.actualtemp is None:
+            return
 
         # Update the log file
         ho = 1 if self.switch.current() else 0
@@ -139,60 +214,144 @@ class PidLoop(object):
         self.world_publisher.maybe_tell_the_world()
             
 
+    def savecheckpoint(self):
+        if not self.checkpointfile or not self.pidctl:
+            return
+        # _last_time is monotonic, store the wall clock time of the last PID step instead
+        lastcall = time.time() - (time.monotonic() - self.pidctl._last_time)
+        checkpoint.save_state(self.checkpointfile,
+                              {"integral": self.pidctl._integral,
+                               "last_input": self.pidctl._last_input,
+                               "last_output": self.pidctl._last_output,
+                               "lastcall": lastcall, "setpoint": self.setpoint,
+                               "command": self.command, "heatseconds": self.heatseconds,
+                               "heatperiodstart": self.heatperiodstart})
+
+    # Restore the PID state from a checkpoint, using a bumpless transfer (switch to manual, then
+    # back to auto with the saved integral as starting point). If the setpoint did not change and
+    # we restarted in the middle of a heating period, resume it instead of starting a new one.
+    def restore(self, state):
+        logger.info("Restoring PID state: integral %.2f last input %s setpoint %s",
+                    state["integral"], state["last_input"], state["setpoint"])
+        self.pidctl.set_auto_mode(False)
+        self.pidctl.set_auto_mode(True, last_output=state["integral"])
+        self.pidctl._last_input = state["last_input"]
+        self.pidctl._last_output = state["last_output"]
+        # Compute the derivative and integral over the real time elapsed since the last step
+        self.pidctl._last_time = time.monotonic() - max(0, time.time() - state["lastcall"])
+
+        now = time.time()
+        periodend = state["heatperiodstart"] + self.heatingperiod
+        if state["setpoint"] != self.setpoint or not state["heatperiodstart"] <= now < periodend:
+            self.timers.periodic("period", self.heatingperiod, self.slowcallback)
+            return
+        self.command = state["command"]
+        self.heatperiodstart = state["heatperiodstart"]
+        self.periodstart = self.timers.time() - (now - self.heatperiodstart)
+        self.heatseconds = state["heatseconds"]
+        remaining = self.heatperiodstart + self.heatseconds - now
+        logger.info("Resuming heating period, %d S left, heater on for %d S",
+                    periodend - now, max(0, remaining))
+        if remaining > 0:
+            self.switch.turnon()
+            if self.heatseconds < self.heatingperiod:
+                self.timers.at("heater", self.periodstart + self.heatseconds,
+                               self.turnoffcallback)
+        self.timers.periodic("period", self.heatingperiod, self.slowcallback,
+                             start=self.periodstart + self.heatingperiod)
+
+    # Pushed update (called by the trigger): step the PID with the new values and update the
+    # heater state for the current period.
+    def react(self):
+        if self.refresh() or self.actualtemp is None or self.periodstart is None:
+            return
+        command = self.pidctl(self.actualtemp)
+        logger.debug("Event: new command from PID: %.1f", command)
+        self.actuate(command)
+
+    # Set the command for the current period: convert it to heating seconds, avoiding short on /
+    # off times, and set the switch, possibly scheduling the turn off. When called during the
+    # period, the heater is not turned back on for less than fastloopseconds.
+    def actuate(self, command):
+        self.command = command
+        self.heatseconds = pwm.heatseconds(self.heatingperiod, command, self.fastloopseconds)
+        logger.debug("heatseconds: %.1f", self.heatseconds)
+        self.timers.cancel("heater")
+        now = self.timers.firing if self.timers.firing is not None else self.timers.time()
+        remaining = self.periodstart + self.heatseconds - now
+        if self.heatseconds > 0 and (remaining >= self.fastloopseconds or
+                                     (remaining > 0 and self.switch.current())):
+            self.switch.turnon()
+            if self.heatseconds < self.heatingperiod:
+                self.timers.at("heater", self.periodstart + self.heatseconds,
+                               self.turnoffcallback)
+        else:
+            self.switch.turnoff()
+
     def turnoffcallback(self):
         logger.debug("Turning heater off")
         self.switch.turnoff()
             
 
+    # Called by the scheduler at the start of each heating period
     def slowcallback(self):
-        # Test needed because turnoffhandle is initially None
-        if self.turnoffhandle:
-            self.turnoffhandle.cancel()
-        # Schedule next call
-        loop = asyncio.get_running_loop()
-        self.slowhandle = loop.call_later(self.heatingperiod, self.slowcallback)
+        # Use the scheduled period start, not the current time, so that the periods do not drift
+        now = self.timers.time()
+        self.periodstart = self.timers.firing if self.timers.firing is not None else now
+        self.heatperiodstart = time.time() - (now - self.periodstart)
 
-        # Ask PID for the heating duration for the next heater sequence
-        self.command = self.pidctl(self.actualtemp)
-        self.heatperiodstart = time.time()
-        # Command is 0-100
-        self.heatseconds = (self.heatingperiod * self.command) / 100.0
-
-        # Adjust result to avoid short on / off times
-        if self.heatseconds < (self.heatingperiod / 20) or self.heatseconds < self.fastloopseconds:
-            self.heatseconds = 0
-        if self.heatseconds > 0.95 * self.heatingperiod or \
-           self.heatseconds > self.heatingperiod - self.fastloopseconds:
-            self.heatseconds = self.heatingperiod + 10
-        logger.debug("New result from PID: heatseconds: %.1f" % self.heatseconds)
-
-        # Set the switch, possibly scheduling turn off 
-        if self.heatseconds > 0:
-            self.switch.turnon()
-            loop = asyncio.get_running_loop()
-            if self.heatseconds < self.heatingperiod:
-                self.turnoff_handle = loop.call_later(self.heatseconds, self.turnoffcallback)
+        # Ask PID for the heating duration for the next heater sequence. Use the safe command if
+        # the temperature is currently unavailable.
+        if self.actualtemp is None:
+            logger.info("No temperature, using safe command %d", self.safecommand)
+            command = self.safecommand
         else:
-            self.switch.turnoff()
+            command = self.pidctl(self.actualtemp)
+        # Command is 0-100. This drops a turn off which would still be pending from the previous
+        # period.
+        self.actuate(command)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Scheduler: %s", self.timers.stats())
+        if self.actualtemp is not None:
+            self.savecheckpoint()
                 
 
 
 async def pidmain(statelogger, switch, setpointgetter, tempgetter, world_publisher,
-                  heatingperiod, kp, ki, kd):
+                  heatingperiod, kp, ki, kd, eventconfig={}, safecommand=0,
+                  checkpointfile=None, checkpointmaxage=0, loopconfig={}):
     loop = asyncio.get_running_loop()
+    sensorfact.attach_loop(loop)
     callbacks = PidLoop(statelogger, switch, setpointgetter, tempgetter, world_publisher,
-                        heatingperiod, kp, ki, kd)
+                        heatingperiod, kp, ki, kd, eventconfig, safecommand,
+                        checkpointfile, checkpointmaxage)
+    # Measure the loop lag and the time spent in our callbacks, to find what blocks the loop.
+    if int(loopconfig.get("loopmonitor", 1)):
+        monitor = loopmon.LoopMonitor(loop, float(loopconfig.get("looplaginterval", 1.0)),
+                                      float(loopconfig.get("loopslowthreshold", 0.1)))
+        for name in ("fastcallback", "evaluate", "react", "slowcallback", "turnoffcallback"):
+            setattr(callbacks, name, monitor.wrap(name, getattr(callbacks, name)))
+        monitor.start()
+    callbacks.setup_events(loop)
     loop.call_soon(callbacks.fastcallback)
     while True:
         await asyncio.sleep(10000)
 
 
-def onoffloop(statelogger, switch, setpointgetter, tempgetter, world_publisher, hysteresis):
+def onoffloop(statelogger, switch, setpointgetter, tempgetter, world_publisher, hysteresis,
+              sampler, safecommand=0, safeperiod=1800):
 
     # We never switch on or off for less than 10 minutes.
     cycleminutes = 10
     switch.turnoff()
     onoff = 0
+    # While the temperature is unavailable, the heater is on for the safe command share of each
+    # safe period, as in PID mode. safestart is the start of the current outage.
+    safeseconds = pwm.heatseconds(safeperiod, safecommand, cycleminutes * 60)
+    safestart = None
+    # Allow the first switch at once
+    lastchange = time.monotonic() - cycleminutes * 60
+    setpoint = None
     while True:
         setpoint_saved = setpoint
         setpoint = setpointgetter.get()
@@ -203,23 +362,45 @@ def onoffloop(statelogger, switch, setpointgetter, tempgetter, world_publisher,
         # and reboot
         actualtemp = tempgetter.gettemp()
         if actualtemp is None:
+            # Safe state while we can't read the temperature
+            now = time.monotonic()
+            if safestart is None:
+                logger.info("No temperature, using safe command %d", safecommand)
+                safestart = now
+            safeonoff = 1 if (now - safestart) % safeperiod < safeseconds else 0
+            if safeonoff != onoff:
+                if safeonoff:
+                    switch.turnon()
+                else:
+                    switch.turnoff()
+                onoff = safeonoff
+                lastchange = now
             time.sleep(15)
             continue
+        safestart = None
 
         savedonoff = onoff
-        if actualtemp < setpoint - hysteresis and not onoff:
-            switch.turnon()
-            onoff = 1
-        if actualtemp > setpoint + hysteresis and onoff:
-            switch.turnoff()
-            onoff = 0
+        lockout = lastchange + cycleminutes * 60 - time.monotonic()
+        if lockout <= 0:
+            if actualtemp < setpoint - hysteresis and not onoff:
+                switch.turnon()
+                onoff = 1
+            if actualtemp > setpoint + hysteresis and onoff:
+                switch.turnoff()
+                onoff = 0
         if savedonoff != onoff:
+            lastchange = time.monotonic()
+            lockout = cycleminutes * 60
             statelogger.logstate({"temp":actualtemp, "set":setpoint, "on":onoff})
 
         logger.debug("onoffloop: temp %.1f setpoint %.1f on %d", actualtemp, setpoint, onoff)
         # Publish our state (git push) from time to time. 
         world_publisher.maybe_tell_the_world()
-        time.sleep(cycleminutes * 60)
+        # Sample faster when close to switching, but there is no point in looking before we
+        # are allowed to switch again.
+        interval = sampler.next_interval(actualtemp,
+                                         [setpoint - hysteresis, setpoint + hysteresis])
+        time.sleep(max(interval, lockout))
 
     # End onoff loop
 
@@ -229,13 +410,19 @@ def init():
 
     global logger
     logger = logging.getLogger("thermostat")
+    metrics.setup(conf)
+    sigprof.setup(conf, "thermostat")
 
     switch = sensorfact.make_switch(conf.as_json(), "switch")
 
-    thermsensor = sensorfact.make_temp(conf.as_json(), "temp")
+    thermsensor = supervisor.SupervisedSensor(
+        lambda: sensorfact.make_temp(conf.as_json(), "temp"), "temp",
+        int(conf.get("tempmaxfailures", 3)), float(conf.get("tempminbackoff", 5)),
+        float(conf.get("tempmaxbackoff", 300)))
     scratchdir = conf.get("scratchdir")
     tempscratch = os.path.join(scratchdir, "ctl") if scratchdir else None
-    tempgetter = TempGetter(thermsensor, tempscratch)
+    tempgetter = TempGetter(thermsensor, tempscratch, float(conf.get("tempfailbudget", 1800)))
+    safecommand = float(conf.get("safecommand", 0))
     
     setpointgetter = setpoint.SetpointGetter(conf)
     gitif = gitele.Gitele(conf)
@@ -253,8 +440,17 @@ def init():
         # half the kp one. Of course it will go up over multiple periods.
         ki = conf.get("pid_ki", kp / (2.0 * heatingperiod))
         kd = conf.get("pid_kd", 0.0)
+        eventconfig = dict([(k, conf.get(k)) for k in
+                            ("eventdriven", "eventdebounce", "eventmininterval", "eventpollseconds")
+                            if conf.get(k) is not None])
+        checkpointfile = os.path.join(scratchdir, "pidstate") if scratchdir else None
+        checkpointmaxage = float(conf.get("pidcheckpointmaxage", 4 * heatingperiod))
+        loopconfig = dict([(k, conf.get(k)) for k in
+                           ("loopmonitor", "looplaginterval", "loopslowthreshold")
+                           if conf.get(k) is not None])
     else:
         hysteresis = float(conf.get("hysteresis") or 0.5)
+        sampler = sampling.make_sampler(conf, 60, 1800, 0.5)
 
     # Let things initialize a bit
     time.sleep(5)
@@ -262,9 +458,11 @@ def init():
     switch.turnoff()
     if using_pid:
         asyncio.run(pidmain(statelogger, switch, setpointgetter, tempgetter, world_publisher,
-                    heatingperiod, kp, ki, kd))
+                    heatingperiod, kp, ki, kd, eventconfig, safecommand,
+                    checkpointfile, checkpointmaxage, loopconfig))
     else:
-        onoffloop(statelogger, switch, setpointgetter, tempgetter, world_publisher, hysteresis)
+        onoffloop(statelogger, switch, setpointgetter, tempgetter, world_publisher, hysteresis,
+                  sampler, safecommand, float(conf.get("heatingperiod", 1800)))
         
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+# Soak test for the PID thermostat: run thermostat.PidLoop through months of virtual time, with a
+# simulated room, a zwavejs2mqtt temperature sensor fed by fake MQTT messages, a fake relay, the
+# schedule setpoint getter and the real state logger and checkpoints (in a temporary directory).
+# The memory allocated by Python is traced, and the test fails if it grows by more than a budget
+# per simulated day after a warm up period (caches, histograms, metrics children filling up).
+#
+# The time functions (time.time, time.monotonic, and the PID clock) are replaced by the virtual
+# clock during the run, so that the timers, timeouts and rate limits behave as in real life.
+# The state logger file names still use the real date.
+#
+# Usage: thermsoak.py [-d days] [-w warmupdays] [-b bytesperday] [-s sampledays] [-t top]
+#                     [-f frames] [-v]
+#  -d: number of simulated days (default 90)
+#  -w: days run before taking the reference snapshot (default 10, the scheduler jitter window
+#      takes about a week to fill up)
+#  -b: memory growth budget in bytes per simulated day (default 4096)
+#  -s: interval between the memory samples in simulated days (default 1)
+#  -t: number of allocation growth sites to report (default 10)
+#  -f: number of stack frames traced per allocation (default 1, more is much slower)
+#  -v: print the memory samples and the errors logged by the thermostat (sensor outages)
+
+import os
+import sys
+import gc
+import math
+import time
+import random
+import logging
+import tempfile
+import tracemalloc
+
+import thermbench
+
+logger = logging.getLogger("thermsoak")
+
+# Wall clock time of virtual time 0: a monday morning, for the schedule
+_epoch = time.mktime((2024, 1, 8, 0, 0, 0, 0, 0, -1))
+_day = 86400.0
+
+
+def rss():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Replace the time functions by the loop's virtual clock while active
+class VirtualClock(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.saved = None
+
+    def monotonic(self):
+        return self.loop.now
+
+    def time(self):
+        return _epoch + self.loop.now
+
+    def __enter__(self):
+        from thermlib import PID
+        self.saved = (time.time, time.monotonic, PID._current_time)
+        time.time = self.time
+        time.monotonic = self.monotonic
+        PID._current_time = self.monotonic
+        return self
+
+    def __exit__(self, *args):
+        from thermlib import PID
+        time.time, time.monotonic, PID._current_time = self.saved
+
+
+# Room temperature model: losses to the outside (daily temperature swing), heating when the relay
+# is on.
+class Room(object):
+    def __init__(self, loop, temp=15.0, tau=20 * 3600.0, heatrate=3.0):
+        self.loop = loop
+        self.temp = temp
+        self.tau = tau
+        # Degrees per second with the heater on
+        self.heat = heatrate / 3600.0
+        self.on = False
+        self.last = loop.now
+
+    def outside(self, tm):
+        return 5.0 + 5.0 * math.sin(2 * math.pi * (tm / _day - 0.375))
+
+    def update(self):
+        now = self.loop.now
+        dt = now - self.last
+        if dt > 0:
+            self.temp += dt * ((self.outside(now) - self.temp) / self.tau +
+                               (self.heat if self.on else 0.0))
+        self.last = now
+        return self.temp
+
+class Relay(object):
+    def __init__(self, room):
+        self.room = room
+        self.switches = 0
+    def turnon(self):
+        self.room.update()
+        if not self.room.on:
+            self.switches += 1
+        self.room.on = True
+    def turnoff(self):
+        self.room.update()
+        self.room.on = False
+    def current(self):
+        return self.room.on
+
+class Gitif(object):
+    def push(self):
+        pass
+
+
+_scheduleconfig = {
+    "default": 16.0,
+    "days": {"work": [["06:30", 20.0], ["08:30", 17.0], ["17:30", 20.5], ["22:30", 16.0]],
+             "home": [["08:00", 20.5], ["23:00", 16.0]]},
+    "week": ["work", "work", "work", "work", "work", "home", "home"],
+    "holidays": [{"from": "2024-02-12", "to": "2024-02-18", "setpoint": 12.0}],
+    "horizon": 7,
+}
+
+
+class Soak(object):
+    def __init__(self, workdir, seed=1):
+        import thermostat
+        import thermlog
+        from thermlib import setpoint, supervisor, zwavejs2mqtt
+        # Normally set by thermostat.init()
+        thermostat.logger = logging.getLogger("thermostat")
+        self.rnd = random.Random(seed)
+        self.loop = thermbench.VirtualLoop()
+        self.room = Room(self.loop)
+        self.relay = Relay(self.room)
+        self.zwave = zwavejs2mqtt
+        zwavejs2mqtt._client = thermbench.FakeMqttClient()
+        self.topic = thermbench._zwtopic
+        # Other values sent by the gateway for the same nodes, received through the wildcard
+        # subscription
+        self.noise = ["zwave/nodeID_%d/49/0/%s" % (n, p) for n in (8, 9, 10)
+                      for p in ("Humidity", "Illuminance")]
+        # Sensor outages: (start, end) times during which the gateway sends nothing
+        self.outages = []
+        tempconfig = {"mqttclient": {"clientid": "soak", "host": "localhost"}}
+        sensor = supervisor.SupervisedSensor(
+            lambda: zwavejs2mqtt.Temp(
+                tempconfig, {"nodeid": 8, "endpoint": 0, "property_current": "Air_temperature",
+                             "maxage": 3600}), "temp")
+        scratchdir = os.path.join(workdir, "scratch")
+        datarepo = os.path.join(workdir, "data")
+        os.mkdir(scratchdir)
+        os.mkdir(datarepo)
+        # Local ui file without a setting: parsed on each get(), as in real life
+        with open(os.path.join(scratchdir, "ui"), "w") as f:
+            print("# no local setting", file=f)
+        setpointgetter = setpoint.SetpointGetter({"setpointgettertype": "schedule",
+                                                  "schedule": _scheduleconfig,
+                                                  "scratchdir": scratchdir})
+        tempgetter = thermostat.TempGetter(sensor, os.path.join(scratchdir, "ctl"),
+                                           failbudget=1e12)
+        self.pidloop = thermostat.PidLoop(
+            thermlog.StateLogger(datarepo), self.relay, setpointgetter, tempgetter,
+            thermostat.Publisher(Gitif()), 600, 100.0, 100.0 / 1200, 0.0,
+            {"eventdriven": False}, 0, os.path.join(scratchdir, "pidstate"), 2400)
+        self.pidloop.timers.loop = self.loop
+        self.evaluations = 0
+
+    # Gateway reports: every minute, plus the other nodes' values
+    def report(self):
+        self.loop.call_later(60, self.report)
+        now = self.loop.now
+        if [o for o in self.outages if o[0] <= now < o[1]]:
+            return
+        gwtime = int(1000 * (_epoch + now))
+        temp = self.room.update() + self.rnd.gauss(0, 0.05)
+        self.zwave._on_message(None, None, thermbench.FakeMqttMessage(
+            self.topic, ('{"time":%d,"value":%.2f}' % (gwtime, temp)).encode()))
+        for topic in self.noise:
+            self.zwave._on_message(None, None, thermbench.FakeMqttMessage(
+                topic, ('{"time":%d,"value":%d}' % (gwtime, self.rnd.randint(0, 100))).encode()))
+
+    # Same as PidLoop.fastcallback, on the virtual loop
+    def poll(self):
+        self.loop.call_later(self.pidloop.pollseconds, self.poll)
+        self.pidloop.evaluate()
+        self.evaluations += 1
+
+    def start(self, days):
+        # A few hours of sensor outage every ten days, to exercise the sensor rebuilds
+        for day in range(5, days, 10):
+            start = day * _day + self.rnd.uniform(0, _day)
+            self.outages.append((start, start + self.rnd.uniform(2, 6) * 3600))
+        self.report()
+        self.loop.call_soon(self.poll)
+
+    def run_until(self, tm):
+        self.loop.run_until(tm)
+
+
+def _snapshot():
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")))
+
+# Least squares slope of y(x)
+def _slope(xs, ys):
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    den = sum([(x - mx) ** 2 for x in xs])
+    return sum([(x - mx) * (y - my) for x, y in zip(xs, ys)]) / den if den else 0.0
+
+
+# Run the soak. Returns True if the memory growth is within the budget.
+def soak(days=90, warmup=10, budget=4096, sampledays=1, top=10, frames=1):
+    workdir = tempfile.mkdtemp(prefix="thermsoak-")
+    tracemalloc.start(frames)
+    start = time.perf_counter()
+    try:
+        soak = Soak(workdir)
+        with VirtualClock(soak.loop):
+            soak.start(days)
+            soak.run_until(warmup * _day)
+            reference = _snapshot()
+            samples = []
+            day = warmup
+            while day < days:
+                day = min(days, day + sampledays)
+                soak.run_until(day * _day)
+                gc.collect()
+                traced = tracemalloc.get_traced_memory()[0]
+                samples.append((day, traced, rss()))
+                logger.info("day %5.1f temp %5.2f traced %9d rss %9d", day, soak.room.temp,
+                            traced, samples[-1][2])
+            final = _snapshot()
+    finally:
+        tracemalloc.stop()
+        import shutil
+        shutil.rmtree(workdir, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+
+    xs = [s[0] for s in samples]
+    traceslope = _slope(xs, [s[1] for s in samples])
+    rssslope = _slope(xs, [s[2] for s in samples])
+    print("%d simulated days in %.1f S: %d evaluations, %d relay cycles, %d sensor outages" %
+          (days, elapsed, soak.evaluations, soak.relay.switches, len(soak.outages)))
+    print("Traced memory: %d -> %d bytes, %.0f bytes/day (budget %d)" %
+          (samples[0][1], samples[-1][1], traceslope, budget))
+    print("RSS: %d -> %d kB, %.0f bytes/day" %
+          (samples[0][2] / 1024, samples[-1][2] / 1024, rssslope))
+    print("Top allocation growth since day %g:" % warmup)
+    for stat in final.compare_to(reference, "lineno")[:top]:
+        if stat.size_diff <= 0:
+            break
+        print("  %+9d B %+6d blocks  %s" % (stat.size_diff, stat.count_diff,
+                                            " <- ".join(["%s:%d" % (f.filename, f.lineno)
+                                                         for f in stat.traceback])))
+    ok = traceslope <= budget
+    if not ok:
+        print("FAILED: memory grows by %.0f bytes per simulated day" % traceslope)
+    return ok
+
+
+if __name__ == '__main__':
+    def perr(s):
+        print("%s"%s, file=sys.stderr)
+    def usage():
+        perr("Usage: thermsoak.py [-d days] [-w warmupdays] [-b bytesperday] [-s sampledays] "
+             "[-t top] [-f frames] [-v]")
+        sys.exit(1)
+    options = {"-d": 90, "-w": 10, "-b": 4096, "-s": 1, "-t": 10, "-f": 1}
+    verbose = False
+    args = sys.argv[1:]
+    while args:
+        if args[0] == "-v":
+            verbose = True
+            args = args[1:]
+        elif args[0] in options and len(args) > 1:
+            try:
+                options[args[0]] = float(args[1])
+            except ValueError:
+                usage()
+            args = args[2:]
+        else:
+            usage()
+    logging.basicConfig(level=logging.ERROR if verbose else logging.CRITICAL)
+    logger.setLevel(logging.INFO if verbose else logging.ERROR)
+    ok = soak(int(options["-d"]), options["-w"], options["-b"], options["-s"],
+              int(options["-t"]), int(options["-f"]))
+    sys.exit(0 if ok else 1)